@@ -0,0 +1,76 @@
+# A record of the inputs used to build each output of create_plots.py, so an
+# incremental build only rebuilds the outputs whose inputs have changed. The
+# inputs of an output are the contents of its input files plus the arguments
+# used to build it.
+
+import glob
+import hashlib
+import json
+import os
+
+import ResultsCache
+
+# bump this whenever a change to the analysis changes its outputs, so that
+# everything is rebuilt
+MANIFEST_VERSION = 1
+
+class BuildManifest:
+    # if incremental is False the previous manifest is ignored, so every
+    # output is rebuilt
+    def __init__(self, manifest_file, incremental=True):
+        self.manifest_file = manifest_file
+        self.previous = {} # output -> input hash from the last build
+        self.current = {} # output -> input hash for this build
+        self.failed_outputs = set()
+        self.file_hashes = {}
+
+        if incremental and os.path.exists(manifest_file):
+            with open(manifest_file, 'r') as f:
+                manifest = json.load(f)
+
+            if manifest["version"] == MANIFEST_VERSION:
+                self.previous = manifest["outputs"]
+
+    def fileHash(self, path):
+        path = os.path.abspath(path)
+        if not path in self.file_hashes:
+            self.file_hashes[path] = ResultsCache.contentHash(path)
+
+        return self.file_hashes[path]
+
+    def inputHash(self, input_files, args):
+        h = hashlib.sha1()
+        for path in input_files:
+            h.update(self.fileHash(path).encode("utf-8"))
+        h.update(repr(args).encode("utf-8"))
+        return h.hexdigest()
+
+    # True if the output exists and was built from the same inputs. The
+    # output is recorded as part of this build either way.
+    def isCurrent(self, output, input_files, args):
+        input_hash = self.inputHash(input_files, args)
+        self.current[output] = input_hash
+        return self.previous.get(output) == input_hash and os.path.exists(output)
+
+    # The output could not be built, so it is left out of the manifest (and is
+    # built again next time). Anything it left behind is kept.
+    def failed(self, output):
+        self.current.pop(output, None)
+        self.failed_outputs.add(output)
+
+    # Write the manifest for this build, and remove the stats and plots for
+    # any outputs which are no longer built (e.g. a participant was removed).
+    def save(self):
+        for output in self.previous:
+            if output in self.current or output in self.failed_outputs or not output.endswith(".png.stats.csv"):
+                continue
+
+            graph_output_png = output[:-len(".stats.csv")]
+            for path in [output] + glob.glob(glob.escape(graph_output_png[:-4]) + "*.png"):
+                if os.path.exists(path):
+                    os.remove(path)
+
+        with open(self.manifest_file, 'w') as f:
+            json.dump({"version": MANIFEST_VERSION, "outputs": self.current}, f, indent=1)
+
+# EOF
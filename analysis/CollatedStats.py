@@ -1,20 +1,29 @@
 import csv
-from math import sqrt
+import numpy as np
 import os
 import sys
 
-from ExperimentResults import gazePosFromBothEyes, BAD_BOTH, subjectToLabel, ALL_STUDIES
+from ExperimentResults import loadResultsColumns, badSideMasks, BAD_BOTH, subjectToLabel, ALL_STUDIES
+from GroupedStats import groupBounds
+from ValidityMasks import unpackMask
 
-# this class contains all of the Qualtrics data as well as the stats data
+# this class contains all of the Qualtrics data as well as the stats data.
+# The stats come either from the participant stats and raw data CSV files, or
+# straight from ExperimentResults objects (participant ID -> results) if
+# results is given.
 class CollatedStats:
-    def __init__(self, qualtrics_csv, participant_csv, raw_csv, study=ALL_STUDIES[1]):
+    def __init__(self, qualtrics_csv, participant_csv, raw_csv, study=ALL_STUDIES[1], results=None, distance_cm=None):
         self.study = study
         self.participantData = {}
+        self.targetIndex = {} # (participant, label, target ID) -> TargetStats
         self.warnMissingTargets = False
 
         self.loadQualtricsData(qualtrics_csv)
-        self.loadParticipantData(participant_csv)
-        self.loadRawData(raw_csv)
+        if results is not None:
+            self.loadExperimentResults(results, distance_cm)
+        else:
+            self.loadParticipantData(participant_csv)
+            self.loadRawData(raw_csv)
 
     def loadQualtricsData(self, qualtrics_csv):
         if not os.path.exists(qualtrics_csv):
@@ -58,7 +67,7 @@ class CollatedStats:
             for row in reader:
                 participant = int(row['participant'])
                 if not participant in self.participantData:
-                    print("INFO: skipping record as not in Qualtrics: " + participant)
+                    print("INFO: skipping record as not in Qualtrics: " + str(participant))
                     continue
 
                 tStats = TargetStats()
@@ -85,60 +94,105 @@ class CollatedStats:
                 tStats.badReadLeft = int(row['bad_left'])
                 tStats.rawDistanceValuesPx = []
 
-                self.participantData[participant].targetStats.append(tStats)
-
-                if self.participantData[participant].PxToDegConvFactor is None:
-                    self.participantData[participant].PxToDegConvFactor = (tStats.accuracyDeg / tStats.accuracyPx)
+                self.addTargetStats(tStats)
+
+    def addTargetStats(self, tStats):
+        participant = tStats.participant
+        self.participantData[participant].targetStats.append(tStats)
+
+        # if there are duplicates, raw data goes to the first record
+        self.targetIndex.setdefault((participant, tStats.label, tStats.targetID), tStats)
+
+        if self.participantData[participant].PxToDegConvFactor is None:
+            self.participantData[participant].PxToDegConvFactor = (tStats.accuracyDeg / tStats.accuracyPx)
+
+    # The same as loadParticipantData followed by loadRawData, but using the
+    # stats and target distances already worked out by ExperimentResults.
+    # Each of the results should hold the data for one participant only.
+    def loadExperimentResults(self, results, distance_cm):
+        for participant, ex_data in results.items():
+            participant = int(participant)
+            if not participant in self.participantData:
+                print("INFO: skipping record as not in Qualtrics: " + str(participant))
+                continue
+
+            for s in ex_data.getStats(distance_cm=distance_cm, participant=str(participant)).values():
+                for eStats in [s] + list(s.targets.values()):
+                    tStats = TargetStats()
+                    tStats.participant = participant
+                    tStats.label = eStats.label
+                    tStats.targetID = ("all" if eStats.target is None else eStats.target)
+                    tStats.testN = eStats.test_n
+                    tStats.recordN = eStats.record_n
+                    tStats.workingDistanceCm = float(distance_cm)
+                    tStats.accuracyPx = float(eStats.accuracy_px)
+                    tStats.accuracyDeg = float(eStats.accuracy_deg)
+                    tStats.precisionPx = float(eStats.precision_px)
+                    tStats.precisionDeg = float(eStats.precision_deg)
+                    tStats.badReadBoth = eStats.bad_data_both
+                    tStats.badReadRight = eStats.bad_data_right
+                    tStats.badReadLeft = eStats.bad_data_left
+                    tStats.rawDistanceValuesPx = []
+
+                    self.addTargetStats(tStats)
+
+            # add the distances for each target to the participant's records
+            idents, ident_codes, target_ids, distances, num_targets = ex_data.getTargetDistances()
+            groups, group_codes = np.unique(ident_codes * num_targets + target_ids, return_inverse=True)
+            order, starts, counts = groupBounds(group_codes, len(groups))
+            for group, dists in zip(groups, np.split(distances[order], starts[1:])):
+                ident = idents[group // num_targets]
+                target_id = int(group % num_targets)
+
+                rec = self.targetIndex.get((participant, subjectToLabel(ident), target_id))
+                if rec is not None:
+                    rec.rawDistanceValuesPx += dists.tolist()
+
+                    # also add in the position (the Label part of the identifier)
+                    rec.position = ident[1]
+                elif self.warnMissingTargets:
+                    print("ERROR: target record not found for " + subjectToLabel(ident) + " :: " + str(target_id) + " :: " + str(participant))
 
     def loadRawData(self, raw_csv):
         if not os.path.exists(raw_csv):
             print("ERROR: Raw data file does not exist: " + raw_csv, file=sys.stderr)
             sys.exit(1)
 
-        with open(raw_csv, 'r') as csvfile:
-            reader = csv.DictReader(csvfile)
-            for row in reader:
-                # detect header rows
-                if row['Target-ID'] == "Target-ID":
-                    continue
+        columns, _, _ = loadResultsColumns(raw_csv)
 
-                participant = int(row['Subject'])
-                if not participant in self.participantData:
-                    print("INFO: skipping record as not in Qualtrics: " + participant)
-                    continue
-                
-                if self.participantData[participant].targetStats is None:
-                    print("ERROR: stats data has not been loaded yet for " + participant, file=sys.stderr)
-                    continue
+        # calculate the distance from the target to the recorded position
+        distances = np.sqrt((columns['Target-X'] - columns['Gaze-X']) ** 2\
+                          + (columns['Target-Y'] - columns['Gaze-Y']) ** 2)
 
-                # calculate the distance from the target to the recorded position
-                target_id = int(row['Target-ID'])
-                label = subjectToLabel((row['Tracker'], row['Label']))
+        both_bad = unpackMask(badSideMasks(columns)[BAD_BOTH], len(distances))
 
-                target_x = int(row['Target-X'])
-                target_y = int(row['Target-Y'])
-                gazePos, bad_side = gazePosFromBothEyes((int(row['Actual-X-Right']), int(row['Actual-Y-Right'])),\
-                                                        (int(row['Actual-X-Left']), int(row['Actual-Y-Left'])))
+        rows = zip(columns['Subject'].tolist(), columns['Tracker'].tolist(), columns['Label'].tolist(),
+                   columns['Target-ID'].tolist(), distances.tolist(), both_bad.tolist())
+        for subject, tracker, position, target_id, dist, bad in rows:
+            participant = int(subject)
+            if not participant in self.participantData:
+                print("INFO: skipping record as not in Qualtrics: " + str(participant))
+                continue
 
-                # if both eye records are bad, the data are not useful
-                if bad_side == BAD_BOTH:
-                    continue
+            if self.participantData[participant].targetStats is None:
+                print("ERROR: stats data has not been loaded yet for " + str(participant), file=sys.stderr)
+                continue
 
-                dist = sqrt((target_x - gazePos[0]) ** 2\
-                          + (target_y - gazePos[1]) ** 2)
+            # if both eye records are bad, the data are not useful
+            if bad:
+                continue
 
-                # add this to the participant's records
-                targFound = False
-                for rec in self.participantData[participant].targetStats:
-                    if not targFound and rec.label == label and rec.targetID == target_id:
-                        targFound = True
-                        rec.rawDistanceValuesPx.append(dist)
+            label = subjectToLabel((tracker, position))
 
-                        # also add in the position (stored in the Label field in this CSV)
-                        rec.position = row['Label']
+            # add this to the participant's records
+            rec = self.targetIndex.get((participant, label, target_id))
+            if rec is not None:
+                rec.rawDistanceValuesPx.append(dist)
 
-                if not targFound and self.warnMissingTargets:
-                    print("ERROR: target record not found for " + str(label) + " :: " + str(target_id) + " :: " + str(participant))
+                # also add in the position (stored in the Label field in this CSV)
+                rec.position = position
+            elif self.warnMissingTargets:
+                print("ERROR: target record not found for " + str(label) + " :: " + str(target_id) + " :: " + str(participant))
 
 class QualtricsRecord:
     def __init__(self):
@@ -1,14 +1,20 @@
-from math import atan, ceil, sqrt
+from collections import OrderedDict
+from math import atan, ceil, floor
+from matplotlib.artist import Artist
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.collections import EllipseCollection
+from matplotlib.figure import Figure
 import matplotlib.cm as pltcm
 import matplotlib.colors as pltcolors
 import matplotlib.patches as mpatches
 import matplotlib.pyplot as plt
+import numpy as np
 from numpy import rad2deg
 import os
-from statistics import pstdev
 
 import ExperimentResults
 from ExperimentStats import ExperimentStats
+from GroupedStats import groupedMeanPstdev
 
 # some of our plots have lots of subplots
 from matplotlib import rc
@@ -22,13 +28,60 @@ PLOT_DPI = 200
 PLOT_FONT_SIZE = 'large'
 COLOURMAP = "jet" #"nipy_spectral"
 
+# the number of rendered plot backgrounds to keep (see getBackground)
+BACKGROUND_CACHE_SIZE = 8
+
+# shaft width of the vector arrows, as a fraction of the plot width. This is
+# what quiver picks for a single arrow, so the arrows look the same however
+# many targets there are.
+VECTOR_WIDTH = 0.06 / 8
+
+# The zorder of the plot background: above the data (patches, collections
+# and lines, up to 2) as it was drawn after it, but below the axes spines
+# and ticks (2.5) which it used to be clipped under.
+BACKGROUND_ZORDER = 2.25
+
+# rendered plot backgrounds, shared by every plot (see getBackground)
+BACKGROUND_CACHE = OrderedDict()
+
+# Draws the background of the axes it is in (see plotBackground) from the
+# cache, so it is only rendered once for each size of plot.
+class PlotBackground(Artist):
+    def __init__(self, plot, label, distance_cm):
+        super().__init__()
+        self.plot = plot
+        self.label = label
+        self.distance_cm = distance_cm
+
+        self.set_zorder(BACKGROUND_ZORDER)
+
+    def draw(self, renderer):
+        if not self.get_visible():
+            return
+
+        # The image covers the whole pixels the axes are in, with the axes at
+        # the same place within them, so it is drawn exactly as the
+        # background would have been drawn straight onto the plot.
+        bbox = self.axes.bbox
+        x0, y0 = floor(bbox.x0), floor(bbox.y0)
+        width, height = ceil(bbox.x1) - x0, ceil(bbox.y1) - y0
+        bounds = (bbox.x0 - x0, bbox.y0 - y0, bbox.width, bbox.height)
+        image = self.plot.getBackground(self.label, self.distance_cm, tuple(self.axes.axis()), bounds,
+                                        width, height, renderer.dpi)
+
+        gc = renderer.new_gc()
+        renderer.draw_image(gc, x0, y0, image[::-1]) # from the bottom row up
+        gc.restore()
+        self.stale = False
+
 class ExperimentPlot:
     def __init__(self, experiment_results):
         self.results = experiment_results
         self.plot_size = experiment_results.plot_size
 
-    def getTargets(self):
-        return self.results.getTargets()
+    # targets for the label, or the last label loaded if None
+    def getTargets(self, label=None):
+        return self.results.getTargets(self.results.default_label if label is None else label)
 
     # Filter the results by subject and/or identifier. Leave these parameters
     # as None to return all results.
@@ -45,13 +98,14 @@ class ExperimentPlot:
 
         return filtered_data
 
-    def plotTargets(self):
-        print(self.getTargets(), self.results.position)
-        for targ in self.getTargets():
-            coords = self.getTargets()[targ]
-            plt.scatter(coords[0], coords[1], marker='x', color=(0.0, 0.0, 0.0, 0.5), s=750)
+    def plotTargets(self, label=None, ax=None):
+        ax = plt.gca() if ax is None else ax
+        targets = self.getTargets(label)
+        if len(targets) > 0:
+            coords = list(targets.values())
+            ax.scatter([c[0] for c in coords], [c[1] for c in coords], marker='x', color=(0.0, 0.0, 0.0, 0.5), s=750)
 
-    def setupCanvas(self, num_plots=1):
+    def setupCanvas(self, num_plots=1, label=None):
         this_dpi = PLOT_DPI * num_plots # this keeps the sizing equal for composite plots
         plt.figure(figsize=(self.plot_size[0]/PLOT_DPI,
                             (self.plot_size[1]*num_plots)/PLOT_DPI),
@@ -61,7 +115,7 @@ class ExperimentPlot:
         plt.gca().invert_yaxis()
 
         # first plot the target positions
-        self.plotTargets()
+        self.plotTargets(label)
 
     def setupColourMapping(self, plot_data):
         colours = pltcm.ScalarMappable(norm=pltcolors.Normalize(vmin=0, vmax=len(plot_data) - 1),\
@@ -112,119 +166,31 @@ class ExperimentPlot:
             fig.set_size_inches(self.plot_size[0]/PLOT_DPI, self.plot_size[1]/PLOT_DPI * 2)
             fig.set_dpi(PLOT_DPI)
 
-        # plot individual graphs separately
-        if save_all:
-            for i, subj in enumerate(plot_data):
-                self.setupCanvas()
-                label = ExperimentResults.subjectToLabel(subj)
-                self.results.position = subj[1]
-
-                plt.axis([-PLOT_PADDING, self.plot_size[0]+PLOT_PADDING, -PLOT_PADDING ,self.plot_size[1]+PLOT_PADDING])
-                plt.gca().invert_yaxis()
-                # plt.title(label, fontsize=PLOT_FONT_SIZE)
-                plt.xlabel("Screen x position (pixels)", fontsize=PLOT_FONT_SIZE)
-                plt.ylabel("Screen y position (pixels)", fontsize=PLOT_FONT_SIZE)
-                for target_id in self.getTargets():
-                    target_coords = self.getTargets()[target_id]
-
-                    colour = (0x01, 0x16, 0x1E) if (i % 2 == 0) else (0x49, 0x11, 0x1C) #(colours.to_rgba(i % 2))
-                    colour = (colour[0] / 0xFF, colour[1] / 0xFF, colour[2] / 0xFF)
-                    x_vals = []
-                    y_vals = []
-                    distances = []
-
-                    # make semi-transparent
-                    colour = (colour[0], colour[1], colour[2], 0.5)
-
-                    for coords in plot_data[subj]:
-                        if coords[0] == target_id and coords[1] != ExperimentResults.INVALID_COORD and coords[2] != ExperimentResults.INVALID_COORD:
-                            x_vals.append(coords[1])
-                            y_vals.append(coords[2])
-
-                            # use pythagoras to determine the distance
-                            dist = sqrt((self.getTargets()[target_id][0] - coords[1]) ** 2\
-                                      + (self.getTargets()[target_id][1] - coords[2]) ** 2)
-                            distances.append(dist)
-
-                    if len(x_vals) > 0 and len(y_vals) > 0:
-                        x_ave = sum(x_vals) / len(x_vals)
-                        y_ave = sum(y_vals) / len(y_vals)
-                        x_targ = self.getTargets()[target_id][0]
-                        y_targ = self.getTargets()[target_id][1]
-                        plt.quiver([x_targ], [y_targ],
-                                   [-(x_targ - x_ave)], [-(y_targ - y_ave)], # negating due to our screen geometry
-                                   color=list((colour)),
-                                   angles='xy', scale_units='xy', scale=1)
-
-                        # add circles to show precision
-                        precision_px = ceil(pstdev(distances))
-                        colour = (colour[0], colour[1], colour[2], 0.1) # make these circles more transparent
-                        polar_grid = mpatches.Circle((x_ave, y_ave), precision_px, fill=True, color=colour)
-                        plt.gcf().gca().add_patch(polar_grid)
-                    else:
-                        print("WARN: no valid data for target " + str(target_id))
-
-                self.plotMonitorEdge()
-                self.plotPolarGrid(distance_cm)
-                self.plotTargets()
-                outfilename = outname[:-4] + label.replace(":", "").replace(" ", "_") + ".png"
-                plt.savefig(outfilename, dpi=PLOT_DPI)
+        # the mean position and precision for every target
+        aggregates = self.vectorAggregates(plot_data, subject)
 
-        # join all plots together
-        plotDims = (ceil(len(plot_data)),1)
-        self.setupCanvas(num_plots=plotDims[0])
+        # Each graph is rendered once, saved if save_all, and then tiled into
+        # the joined up plot, so that is the same size (and quick to make)
+        # however many graphs there are.
+        montage = None
         for i, subj in enumerate(plot_data):
-            label = ExperimentResults.subjectToLabel(subj)
-            self.results.position = subj[1]
+            panel = self.renderVectorPanel(subj, aggregates[subj], i, distance_cm)
+            if montage is None:
+                montage = np.empty((panel.shape[0] * len(plot_data),) + panel.shape[1:], dtype=panel.dtype)
 
-            plt.subplot(*plotDims, len(plot_data) - i, aspect='equal') # plot from bottom to top as it looks nicer
-            plt.axis([-PLOT_PADDING, self.plot_size[0]+PLOT_PADDING, -PLOT_PADDING ,self.plot_size[1]+PLOT_PADDING])
-            plt.gca().invert_yaxis()
-            # plt.title(label, fontsize=PLOT_FONT_SIZE)
-            plt.xlabel("Screen x position (pixels)", fontsize=PLOT_FONT_SIZE)
-            plt.ylabel("Screen y position (pixels)", fontsize=PLOT_FONT_SIZE)
-            for target_id in self.getTargets():
-                target_coords = self.getTargets()[target_id]
+            # plot from bottom to top as it looks nicer
+            row = len(plot_data) - 1 - i
+            montage[row * panel.shape[0]:(row + 1) * panel.shape[0]] = panel
 
-                colour = (colours.to_rgba(i))
-                x_vals = []
-                y_vals = []
-                distances = []
-
-                # make semi-transparent
-                colour = (colour[0], colour[1], colour[2], 0.5)
-
-                for coords in plot_data[subj]:
-                    if coords[0] == target_id and coords[1] != ExperimentResults.INVALID_COORD and coords[2] != ExperimentResults.INVALID_COORD:
-                        x_vals.append(coords[1])
-                        y_vals.append(coords[2])
-
-                        # use pythagoras to determine the distance
-                        dist = sqrt((self.getTargets()[target_id][0] - coords[1]) ** 2\
-                                  + (self.getTargets()[target_id][1] - coords[2]) ** 2)
-                        distances.append(dist)
-
-                if len(x_vals) > 0 and len(y_vals) > 0:
-                    x_ave = sum(x_vals) / len(x_vals)
-                    y_ave = sum(y_vals) / len(y_vals)
-                    x_targ = self.getTargets()[target_id][0]
-                    y_targ = self.getTargets()[target_id][1]
-                    plt.quiver([x_targ], [y_targ],
-                               [-(x_targ - x_ave)], [-(y_targ - y_ave)], # negating due to our screen geometry
-                               color=list((colour)),
-                               angles='xy', scale_units='xy', scale=1)
-
-                    # add circles to show precision
-                    precision_px = ceil(pstdev(distances))
-                    colour = (colour[0], colour[1], colour[2], 0.1) # make these circles more transparent
-                    polar_grid = mpatches.Circle((x_ave, y_ave), precision_px, fill=True, color=colour)
-                    plt.gcf().gca().add_patch(polar_grid)
-                else:
-                    print("WARN: no valid data for target " + str(target_id))
-
-            self.plotMonitorEdge()
-            self.plotPolarGrid(distance_cm)
-            self.plotTargets()
+            if save_all:
+                label = ExperimentResults.subjectToLabel(subj)
+                outfilename = outname[:-4] + label.replace(":", "").replace(" ", "_") + ".png"
+                plt.imsave(outfilename, panel, dpi=PLOT_DPI)
+
+        # join all plots together
+        if montage is not None:
+            plt.figure(figsize=(montage.shape[1] / PLOT_DPI, montage.shape[0] / PLOT_DPI), dpi=PLOT_DPI)
+            plt.figimage(montage)
 
         if not split:
             # manually generate the legend
@@ -236,9 +202,108 @@ class ExperimentPlot:
 
             # plt.legend(loc="upper left", bbox_to_anchor=(1.05, 1.01), title="Legend", fontsize="medium", title_fontsize="large", handles=legend_elements)
 
-    def plotStats(self, subject=None, identifier=None, distance_cm=None, participant=None, split=True):
+    # Render the vector plot of one identifier (the ith in the plot) on its
+    # own, returning it as an RGBA image. aggregates are the identifier's from
+    # vectorAggregates.
+    def renderVectorPanel(self, subj, aggregates, i, distance_cm=None):
+        self.setupCanvas(label=subj[1])
+
+        plt.axis([-PLOT_PADDING, self.plot_size[0]+PLOT_PADDING, -PLOT_PADDING ,self.plot_size[1]+PLOT_PADDING])
+        plt.gca().invert_yaxis()
+        # plt.title(ExperimentResults.subjectToLabel(subj), fontsize=PLOT_FONT_SIZE)
+        plt.xlabel("Screen x position (pixels)", fontsize=PLOT_FONT_SIZE)
+        plt.ylabel("Screen y position (pixels)", fontsize=PLOT_FONT_SIZE)
+
+        colour = (0x01, 0x16, 0x1E) if (i % 2 == 0) else (0x49, 0x11, 0x1C) #(colours.to_rgba(i % 2))
+        colour = (colour[0] / 0xFF, colour[1] / 0xFF, colour[2] / 0xFF)
+        self.plotTargetVectors(aggregates, colour)
+        self.plotBackground(subj[1], distance_cm)
+
+        # render with Agg whatever the pyplot backend, once the figure is
+        # closed so pyplot doesn't keep it around
+        fig = plt.gcf()
+        plt.close(fig)
+        canvas = FigureCanvasAgg(fig)
+        canvas.draw()
+        return np.asarray(canvas.buffer_rgba()).copy()
+
+    # The targets of each identifier in plot_data (as from filterBySubject),
+    # with the mean gaze position and precision (rounded up to whole pixels)
+    # of the valid samples for each. These are arrays in the order of the
+    # targets for the identifier's label: (target IDs, target coords, mean
+    # coords, precision, whether there were any samples).
+    def vectorAggregates(self, plot_data, subject=None):
+        idents = list(plot_data)
+        ident_codes, target_ids, x_pos, y_pos = self.results.getSampleArrays(idents, subject)
+
+        valid = (x_pos != ExperimentResults.INVALID_COORD) & (y_pos != ExperimentResults.INVALID_COORD)
+        ident_codes = ident_codes[valid]
+        target_ids = target_ids[valid]
+        x_pos = x_pos[valid]
+        y_pos = y_pos[valid]
+
+        # the coords of each target for each identifier, NaN for samples of
+        # targets which aren't in the label's targets
+        ident_targets = [self.getTargets(ident[1]) for ident in idents]
+        num_targets = max([int(target_ids.max()) + 1 if len(target_ids) > 0 else 0] +\
+                          [t + 1 for targets in ident_targets for t in targets])
+        target_coords = np.full((len(idents), num_targets, 2), np.nan)
+        for i, targets in enumerate(ident_targets):
+            for target_id, coords in targets.items():
+                target_coords[i, target_id] = coords
+
+        # group the samples by identifier and target
+        num_groups = len(idents) * num_targets
+        group_codes = ident_codes * num_targets + target_ids
+        sample_targets = target_coords[ident_codes, target_ids]
+        counts = np.bincount(group_codes, minlength=num_groups)
+        with np.errstate(invalid="ignore", divide="ignore"): # NaN for targets without samples
+            mean_x = np.bincount(group_codes, weights=x_pos, minlength=num_groups) / counts
+            mean_y = np.bincount(group_codes, weights=y_pos, minlength=num_groups) / counts
+
+        # use pythagoras to determine the distance
+        distances = np.sqrt((sample_targets[:, 0] - x_pos) ** 2 + (sample_targets[:, 1] - y_pos) ** 2)
+        _, precision = groupedMeanPstdev(distances, group_codes, num_groups)
+
+        aggregates = {}
+        for i, ident in enumerate(idents):
+            ids = np.array(list(ident_targets[i]), dtype=np.int64)
+            groups = i * num_targets + ids
+            aggregates[ident] = (ids, target_coords[i, ids].reshape(-1, 2),
+                                 np.column_stack((mean_x[groups], mean_y[groups])),
+                                 np.ceil(precision[groups]), counts[groups] > 0)
+
+        return aggregates
+
+    # Plot the vectors from each target to the mean gaze position, with circles
+    # showing the precision, for one set of aggregates from vectorAggregates.
+    def plotTargetVectors(self, aggregates, colour):
+        target_ids, target_coords, mean_coords, precision, found = aggregates
+        for target_id in target_ids[~found].tolist():
+            print("WARN: no valid data for target " + str(target_id))
+
+        if not np.any(found):
+            return
+
+        # make semi-transparent
+        colour = (colour[0], colour[1], colour[2], 0.5)
+        target_coords = target_coords[found]
+        mean_coords = mean_coords[found]
+        vectors = mean_coords - target_coords
+        plt.quiver(target_coords[:, 0], target_coords[:, 1], vectors[:, 0], vectors[:, 1],
+                   color=colour, width=VECTOR_WIDTH, angles='xy', scale_units='xy', scale=1)
+
+        # add circles to show precision
+        colour = (colour[0], colour[1], colour[2], 0.1) # make these circles more transparent
+        diameters = 2 * precision[found]
+        circles = EllipseCollection(diameters, diameters, np.zeros(len(diameters)), units='xy',
+                                    offsets=mean_coords, offset_transform=plt.gca().transData,
+                                    facecolors=colour, edgecolors=colour, linewidths=plt.rcParams['patch.linewidth'])
+        plt.gca().add_collection(circles, autolim=False)
+
+    def plotStats(self, subject=None, identifier=None, distance_cm=None, participant=None, split=True, targets=None):
         # add the accuracy and precision data to the plot
-        stats = self.results.getStats(subject, identifier, distance_cm, participant)
+        stats = self.results.getStats(subject, identifier, distance_cm, participant, targets)
 
         stats_text = ""
         stats_verbose = ExperimentStats.csv_header()
@@ -270,17 +335,56 @@ class ExperimentPlot:
         # return a textual representation of the stats
         return stats_verbose
 
-    
-    def plotMonitorEdge(self):
+    # The monitor edge, polar grid and targets over the top of the current
+    # plot. These only depend on the screen, the distance and the targets, so
+    # are rendered once (see getBackground) and drawn as an image.
+    def plotBackground(self, label=None, distance_cm=None):
+        plt.gca().add_artist(PlotBackground(self, label, distance_cm))
+
+    # The background for the label and distance, rendered as an RGBA image of
+    # width x height pixels for axes with the given limits, at bounds (x, y,
+    # width, height in pixels from the bottom left) in the image. The most
+    # recently used backgrounds are kept in BACKGROUND_CACHE.
+    def getBackground(self, label, distance_cm, limits, bounds, width, height, dpi):
+        targets = tuple(sorted(self.getTargets(label).items()))
+        key = (ExperimentResults.SCREEN_RESOLUTION, distance_cm, targets, limits,
+               tuple(round(b, 6) for b in bounds), width, height, dpi)
+        if key in BACKGROUND_CACHE:
+            BACKGROUND_CACHE.move_to_end(key)
+            return BACKGROUND_CACHE[key]
+
+        # a transparent figure of exactly width x height pixels, outside of
+        # pyplot so the current figure isn't changed
+        fig = Figure(figsize=((width + 1e-6) / dpi, (height + 1e-6) / dpi), dpi=dpi)
+        canvas = FigureCanvasAgg(fig)
+        fig.patch.set_alpha(0)
+        ax = fig.add_axes((bounds[0] / width, bounds[1] / height, bounds[2] / width, bounds[3] / height))
+        ax.set_axis_off()
+        ax.axis(limits)
+
+        self.plotMonitorEdge(ax)
+        self.plotPolarGrid(distance_cm, ax=ax)
+        self.plotTargets(label, ax)
+        canvas.draw()
+
+        BACKGROUND_CACHE[key] = np.asarray(canvas.buffer_rgba()).copy()
+        while len(BACKGROUND_CACHE) > BACKGROUND_CACHE_SIZE:
+            BACKGROUND_CACHE.popitem(last=False)
+        return BACKGROUND_CACHE[key]
+
+    def plotMonitorEdge(self, ax=None):
+        ax = plt.gca() if ax is None else ax
         res = ExperimentResults.SCREEN_RESOLUTION;
         monitor_edge = mpatches.Rectangle((0, 0), res[0], res[1], linewidth=1, fill=False, edgecolor="grey")
-        plt.gcf().gca().add_patch(monitor_edge)
+        ax.add_patch(monitor_edge)
 
-    def plotPolarGrid(self, distance_cm=None, angle_delta=5, colour="#777777FF"):
+    def plotPolarGrid(self, distance_cm=None, angle_delta=5, colour="#777777FF", ax=None):
         # if no distance is given, we can't calculate angles
         if distance_cm is None:
             return
 
+        ax = plt.gca() if ax is None else ax
+
         # it is easier to draw these circles manually than mess about with
         # plt.axes(projection="polar", facecolor="#FFFFFF00" ...)
         px_per_deg = ExperimentResults.pixelsPerDegree(distance_cm)
@@ -292,14 +396,14 @@ class ExperimentPlot:
             # circles
             radius = n * px_per_deg * angle_delta
             polar_grid = mpatches.Circle(origin, radius, fill=False, color=colour)
-            plt.gcf().gca().add_patch(polar_grid)
+            ax.add_patch(polar_grid)
 
             # labels
-            plt.text(origin[0] + radius - 5, origin[1], str(n * angle_delta) + u'\N{DEGREE SIGN}', horizontalalignment="right", color=colour) 
-            plt.text(origin[0] - radius + 5, origin[1], str(n * angle_delta) + u'\N{DEGREE SIGN}', horizontalalignment="left", color=colour)
+            ax.text(origin[0] + radius - 5, origin[1], str(n * angle_delta) + u'\N{DEGREE SIGN}', horizontalalignment="right", color=colour) 
+            ax.text(origin[0] - radius + 5, origin[1], str(n * angle_delta) + u'\N{DEGREE SIGN}', horizontalalignment="left", color=colour)
 
         # cross for the origin
-        plt.plot(origin[0], origin[1], 'x', color=colour)
-        plt.plot(origin[0], origin[1], '+', color=colour)
+        ax.plot(origin[0], origin[1], 'x', color=colour)
+        ax.plot(origin[0], origin[1], '+', color=colour)
 
 # EOF
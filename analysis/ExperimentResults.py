@@ -1,10 +1,20 @@
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
 import csv
+import glob
+from itertools import compress
 from math import atan, sqrt
+import numpy as np
 from numpy import rad2deg
-from scipy import stats
-from statistics import mean, pstdev
+import os
+import sys
 
 from ExperimentStats import ExperimentStats
+from GroupedStats import KSTEST, combinedMeanPstdev, groupBounds, groupedNormalityTest, groupedSums
+import ResultsCache
+from ValidityMasks import concatMasks, groupedPopcount, invertMask, packMask, unpackMask
+from SampleStore import SampleStore, SubjectDataView
+from TargetLayout import TargetLayout, maskIncludes, targetMask
 
 DATA_COLS = {
     "Label": 0,
@@ -22,6 +32,9 @@ DATA_COLS = {
     "Actual-Y-Left": 12
 }
 
+# columns holding text - everything else in DATA_COLS is an integer
+TEXT_COLS = ("Label", "Subject", "Tracker", "Timestamp")
+
 INVALID_COORD = 0x7FFFFFFF # INT_MAX in C
 
 # screen settings
@@ -34,6 +47,10 @@ ALL_STUDIES = ("position", "validation")
 BAD_RIGHT = 0
 BAD_LEFT = 1
 BAD_BOTH = 2
+# the right and left eye columns for each axis. In loaded columns these hold
+# COORD_DTYPE coordinates, with a validity mask for each (see packEyeColumns).
+EYE_COLS = (("Actual-X-Right", "Actual-X-Left"), ("Actual-Y-Right", "Actual-Y-Left"))
+COORD_DTYPE = np.int16
 
 # calculate the hypotenuse of a right angle triangle using the screen resolution.
 # e.g a 800x600 monitor would make a triangle with sides 800, 600, and hypotenuse.
@@ -44,6 +61,29 @@ PIXEL_SIZE_CM = SCREEN_SIZE_CM / PIXEL_HYPOTENUSE
 # invalid readings as MAX_INT or another overly large number.
 REMOVE_DUPLICATE_READINGS = False
 
+# the number of different sets of getStats arguments to keep the stats for
+STATS_CACHE_SIZE = 32
+
+# set to False to use the original row-by-row CSV loader
+COLUMNAR_LOADING = True
+
+# keep a binary copy of each parsed results file (columnar loading only)
+USE_RESULTS_CACHE = True
+
+# number of processes used to load results files in parallel (None for one
+# per CPU)
+LOAD_WORKERS = None
+
+# the test for the parametric column of the stats (see parametricFlags), and
+# the p-value at or above which the distances count as normally distributed
+NORMALITY_TEST = KSTEST
+PARAMETRIC_SIGNIFICANCE = 0.05
+
+# parsed columns of results files loaded by preloadResults, keyed by absolute
+# path. Datasets collated from these files share the loaded columns rather
+# than reading the files again.
+PRELOADED_RESULTS = {}
+
 ######################
 ## Helper functions ##
 ######################
@@ -57,6 +97,14 @@ def pixelsPerDegree(distance_cm):
     pixels_per_degree = 1.0/pixel_angle
     return pixels_per_degree
 
+# Whether the distances of each group look normally distributed, as the
+# strings shown in the stats. KSTEST compares the distances to the standard
+# normal, as the stats always have. LILLIEFORS (see GroupedStats) compares
+# them to a normal with their own mean and sd.
+def parametricFlags(distances, group_codes, num_groups):
+    _, pvalues = groupedNormalityTest(distances, group_codes, num_groups, NORMALITY_TEST, PARAMETRIC_SIGNIFICANCE)
+    return ["True" if pvalue >= PARAMETRIC_SIGNIFICANCE else "False" for pvalue in pvalues.tolist()]
+
 def gazePosFromBothEyes(right_eye, left_eye):
     bad_side = None
     actual_ave = [INVALID_COORD, INVALID_COORD]
@@ -78,29 +126,342 @@ def gazePosFromBothEyes(right_eye, left_eye):
 
     return actual_ave, bad_side
 
+# Replace the raw eye coordinates in the columns with COORD_DTYPE coordinates
+# (0 where the reading is off screen) and add a packed validity mask for each
+# eye and axis (see ValidityMasks), named as in validMaskName.
+def packEyeColumns(columns):
+    for axis, eye_cols in enumerate(EYE_COLS):
+        for name in eye_cols:
+            raw = np.asarray(columns[name])
+            valid = (0 <= raw) & (raw <= SCREEN_RESOLUTION[axis])
+            columns[name] = np.where(valid, raw, 0).astype(COORD_DTYPE)
+            columns[validMaskName(name)] = packMask(valid)
+
+def validMaskName(eye_col):
+    return eye_col.replace("Actual-", "Valid-")
+
+# Array version of gazePosFromBothEyes for a whole file at a time, using the
+# columns from packEyeColumns. Returns the gaze x and y arrays, which are NaN
+# where neither eye is valid.
+def gazePosFromEyeColumns(columns):
+    count = len(columns["Row"])
+    gaze = []
+    for right_col, left_col in EYE_COLS:
+        right = columns[right_col].astype(np.float64)
+        left = columns[left_col].astype(np.float64)
+        right_ok = unpackMask(columns[validMaskName(right_col)], count)
+        left_ok = unpackMask(columns[validMaskName(left_col)], count)
+
+        gaze.append(np.select([right_ok & left_ok, right_ok, left_ok],
+                              [(right + left) / 2, right, left],
+                              np.nan))
+
+    return gaze[0], gaze[1]
+
+# Packed masks of the rows with a bad right eye, a bad left eye and both eyes
+# bad (the bad sides from gazePosFromBothEyes), worked out a byte at a time
+# from the validity masks.
+def badSideMasks(columns):
+    count = len(columns["Row"])
+    sides = []
+    for right_col, left_col in EYE_COLS:
+        right_ok = columns[validMaskName(right_col)]
+        left_ok = columns[validMaskName(left_col)]
+        sides.append((~right_ok & left_ok, # right bad
+                      right_ok & ~left_ok, # left bad
+                      invertMask(right_ok | left_ok, count))) # both bad
+
+    (right_x, left_x, both_x), (right_y, left_y, both_y) = sides
+
+    # the bad side is upgraded to BAD_BOTH if the axes disagree
+    both = both_x | both_y | (right_x & left_y) | (left_x & right_y)
+    not_both = invertMask(both, count)
+
+    return (right_x | right_y) & not_both, (left_x | left_y) & not_both, both
+
+# the same header check as loadData: a row is data if the last element is a
+# number
+def isDataRow(line):
+    try:
+        _ = int(line.rpartition(",")[2])
+    except ValueError:
+        return False
+    return True
+
+# map each value to the index of its first appearance. Returns the unique
+# values (in order of appearance) and an array of indices into them.
+def factorize(values):
+    uniques = list(dict.fromkeys(values))
+    lookup = {v: i for i, v in enumerate(uniques)}
+    codes = np.fromiter(map(lookup.__getitem__, values), dtype=np.int64, count=len(values))
+    return uniques, codes
+
+# Read a results CSV into one numpy array per column. Header rows (including
+# those embedded in collated files) are skipped, as are any rows excluded by
+# results_filter (see ResultsFilter). Returns the columns, the row indices of
+# the header rows, and the total number of rows in the file.
+def readResultsColumns(data_csv, results_filter=None):
+    with open(data_csv, 'r') as csvfile:
+        lines = csvfile.read().replace('"', '').splitlines()
+
+    is_data = [isDataRow(line) for line in lines]
+    data_lines = [line for line, d in zip(lines, is_data) if d]
+    header_rows = np.array([i for i, d in enumerate(is_data) if not d], dtype=np.int64)
+
+    # fast path: split everything in one go. This only works if none of the
+    # fields contain a comma, so fall back to the csv module if they do.
+    num_cols = len(DATA_COLS)
+    fields = ",".join(data_lines).split(",") if len(data_lines) > 0 else []
+    if len(fields) != len(data_lines) * num_cols:
+        with open(data_csv, 'r') as csvfile:
+            rows = [row for row in csv.reader(csvfile, delimiter=',')\
+                    if len(row) > 0 and isDataRow(row[-1])]
+
+        if any(len(row) != num_cols for row in rows):
+            print("ERROR: unexpected number of columns in " + data_csv, file=sys.stderr)
+            sys.exit(1)
+
+        fields = [field for row in rows for field in row]
+
+    # check the labels, subjects and targets before converting anything else
+    rows = np.flatnonzero(is_data)
+    keep = None
+    if results_filter is not None:
+        labels, label_codes = factorize(fields[DATA_COLS["Label"]::num_cols])
+        subjects, subject_codes = factorize(fields[DATA_COLS["Subject"]::num_cols])
+        target_ids = np.array(fields[DATA_COLS["Target-ID"]::num_cols], dtype=np.int64)
+        keep = results_filter.rowMask(labels, label_codes, subjects, subject_codes, target_ids)
+        rows = rows[keep]
+        keep = keep.tolist()
+
+    columns = {}
+    for name, index in DATA_COLS.items():
+        values = fields[index::num_cols]
+        if keep is not None:
+            values = list(compress(values, keep))
+
+        if name in TEXT_COLS:
+            columns[name] = np.array(values, dtype=object)
+        else:
+            columns[name] = np.array(values, dtype=np.int64)
+
+    columns["Row"] = rows
+
+    return columns, header_rows, len(lines)
+
+# the given rows of loaded columns (see loadResultsColumns)
+def selectRows(columns, keep):
+    count = len(columns["Row"])
+    selected = {}
+    for name, values in columns.items():
+        if name.startswith("Valid-"):
+            selected[name] = packMask(unpackMask(values, count)[keep])
+        else:
+            selected[name] = values[keep]
+
+    return selected
+
+# the rows of loaded columns which pass the filter
+def filterColumns(columns, results_filter):
+    labels, label_codes = factorize(columns["Label"].tolist())
+    subjects, subject_codes = factorize(columns["Subject"].tolist())
+    return selectRows(columns, results_filter.rowMask(labels, label_codes, subjects, subject_codes,
+                                                      columns["Target-ID"]))
+
+# Same as readResultsColumns, but the eye columns are packed (see
+# packEyeColumns) and the gaze position from both eyes is added to the columns
+# as Gaze-X and Gaze-Y. The results are cached so later loads of an unchanged
+# file don't need to parse it again. The cache holds the whole file, so with
+# results_filter the rows to keep are picked using the cached labels, subjects
+# and target IDs, and only those rows of the other columns are read.
+def loadResultsColumns(data_csv, use_cache=None, results_filter=None):
+    if use_cache is None:
+        use_cache = USE_RESULTS_CACHE
+
+    if use_cache:
+        cached = ResultsCache.loadCache(data_csv, decode_text=False)
+        if cached is not None:
+            columns, info = cached
+            header_rows = columns.pop("Header-Rows")
+            text = {name: columns.pop(name) for name in TEXT_COLS}
+            if results_filter is not None:
+                keep = results_filter.rowMask(*text["Label"], *text["Subject"], columns["Target-ID"])
+                columns = selectRows(columns, keep)
+                text = {name: (uniques, codes[keep]) for name, (uniques, codes) in text.items()}
+
+            for name, (uniques, codes) in text.items():
+                columns[name] = np.array(uniques, dtype=object)[codes]
+            return columns, header_rows, info["num_rows"]
+
+    columns, header_rows, num_rows = readResultsColumns(data_csv, None if use_cache else results_filter)
+    packEyeColumns(columns)
+    columns["Gaze-X"], columns["Gaze-Y"] = gazePosFromEyeColumns(columns)
+
+    if use_cache:
+        ResultsCache.saveCache(data_csv, dict(columns, **{"Header-Rows": header_rows}),
+                               {"num_rows": num_rows})
+        if results_filter is not None:
+            columns = filterColumns(columns, results_filter)
+
+    return columns, header_rows, num_rows
+
+# the results files in a directory, in the order collate_results.ps1 uses
+def resultsFiles(data_dir):
+    return sorted((f for f in glob.glob(os.path.join(data_dir, "*.csv")) if not f.endswith(".stats.csv")),
+                  key=lambda f: os.path.basename(f).lower())
+
+# the results files for each participant in a results tree (one directory per
+# participant), keyed by participant ID in directory name order
+def resultsTree(results_dir):
+    tree = OrderedDict()
+    for name in sorted(os.listdir(results_dir), key=str.lower):
+        participant_dir = os.path.join(results_dir, name)
+        if os.path.isdir(participant_dir) and not name.startswith("."):
+            tree[name] = resultsFiles(participant_dir)
+
+    return tree
+
+# Load results files once so they can be shared by any number of datasets
+# collated from them (see collateResultsColumns). The files are parsed on a
+# pool of worker processes if workers is more than 1.
+def preloadResults(data_csvs, workers=1):
+    pending = []
+    for data_csv in data_csvs:
+        path = os.path.abspath(data_csv)
+        if not path in PRELOADED_RESULTS and not path in pending:
+            pending.append(path)
+
+    if workers is None:
+        workers = os.cpu_count()
+
+    if workers > 1 and len(pending) > 1:
+        with ProcessPoolExecutor(max_workers=min(workers, len(pending))) as pool:
+            loaded = list(pool.map(loadResultsColumns, pending))
+    else:
+        loaded = [loadResultsColumns(path) for path in pending]
+
+    for path, columns in zip(pending, loaded):
+        PRELOADED_RESULTS[path] = columns
+
+# Load every results file under results_dir in parallel, and collate them into
+# one ExperimentResults (participants in directory name order). Participants
+# excluded by results_filter are skipped without reading their files.
+def loadResultsTree(results_dir, plot_dimensions, targets_bottom=None, targets_top=None, workers=LOAD_WORKERS,
+                    results_filter=None):
+    tree = resultsTree(results_dir)
+    if results_filter is not None:
+        tree = results_filter.filterTree(tree)
+
+    data_csvs = [f for files in tree.values() for f in files]
+    if len(data_csvs) == 0:
+        print("ERROR: no results files found in " + results_dir, file=sys.stderr)
+        sys.exit(1)
+
+    preloadResults(data_csvs, workers)
+    return ExperimentResults(data_csvs, plot_dimensions, targets_bottom=targets_bottom, targets_top=targets_top,
+                             results_filter=results_filter)
+
+# The same as loading the concatenation of the given results files (as done by
+# collate_results.ps1), without writing it out. If label_prefix is given it is
+# added to the start of every label (e.g. "mf - "). It can also be a list with
+# a prefix (or None) for each file. Rows excluded by results_filter are left
+# out (the filter is applied to the labels before the prefix is added).
+def collateResultsColumns(data_csvs, label_prefix=None, results_filter=None):
+    label_prefixes = label_prefix
+    if not isinstance(label_prefix, list):
+        label_prefixes = [label_prefix] * len(data_csvs)
+
+    parts = []
+    for data_csv, prefix in zip(data_csvs, label_prefixes):
+        loaded = PRELOADED_RESULTS.get(os.path.abspath(data_csv))
+        if loaded is None:
+            columns, header_rows, num_rows = loadResultsColumns(data_csv, results_filter=results_filter)
+        else:
+            columns, header_rows, num_rows = loaded
+            if results_filter is not None:
+                columns = filterColumns(columns, results_filter)
+
+        if prefix is not None:
+            labels, label_codes = factorize(columns["Label"])
+            columns = dict(columns, Label=np.array([prefix + label for label in labels], dtype=object)[label_codes])
+
+        parts.append((columns, header_rows, num_rows))
+
+    if len(parts) == 0:
+        print("ERROR: no results files to collate", file=sys.stderr)
+        sys.exit(1)
+
+    # row numbers carry on from the end of the previous file
+    offsets = np.cumsum([0] + [num_rows for _, _, num_rows in parts])
+    columns = {}
+    for name in parts[0][0]:
+        if name == "Row":
+            columns[name] = np.concatenate([c[name] + offset for (c, _, _), offset in zip(parts, offsets)])
+        elif name.startswith("Valid-"):
+            columns[name] = concatMasks([(c[name], len(c["Row"])) for c, _, _ in parts])
+        else:
+            columns[name] = np.concatenate([c[name] for c, _, _ in parts])
+    header_rows = np.concatenate([h + offset for (_, h, _), offset in zip(parts, offsets)]).astype(np.int64)
+
+    return columns, header_rows, int(offsets[-1])
+
 # this class contains the experiment details (target locations, etc) as well
 # as eye tracking results for each participant.
 class ExperimentResults:
-    def __init__(self, data_csv, plot_dimensions, targets_bottom=None, targets_top=None):
-        self.position = None
+    # data_csv can be a single results file or a list of them to collate.
+    # label_prefix is added to the start of each label (columnar loading only,
+    # see collateResultsColumns). Rows excluded by results_filter (see
+    # ResultsFilter) are dropped as they are read. If data_csv is None nothing
+    # is loaded (see select).
+    def __init__(self, data_csv, plot_dimensions, targets_bottom=None, targets_top=None, columnar=COLUMNAR_LOADING, label_prefix=None,
+                 results_filter=None):
         self.targets_bottom = {}
         self.targets_top = {}
+        self.target_layout = None # target coords per label, built once the data is loaded
+        self.default_label = None # the last label loaded, for plots of all labels
         self.subject_data = {}
         self.ident_count = {}
         self.ident_count_target = {}
         self.invalid_rows = set()
         self.bad_data = {} # a count of bad data per tracker/label pair
         self.target_bad_data = {} # a count of bad data per target for each tracker/label pair
+        self.subject_counts = {} # (subject, identifier) -> [tests, bad right, bad left, bad both] (columnar loading only)
+        self.subject_target_counts = {} # (subject, identifier) -> {target: [records, bad right, bad left, bad both]}
+        self.subject_targets = {} # subject -> (top target IDs, bottom target IDs) in the order they appear
+        self.subject_last_label = {} # subject -> the label of their last row
         self.raw_data = None
-        self.stats = None
+        self.samples = None # valid samples per tracker/label pair (columnar loading only)
+        self.num_rows = 0
+        self.stats = None # the most recent stats returned by getStats
+        self.stats_cache = OrderedDict() # stats for each set of getStats arguments, oldest first
+        self.distances = {} # target distances for each subject/identifier filter
+        self.aggregates = {} # per target sums and stats for each subject/identifier filter
         self.plot_size = plot_dimensions
-        self.loadData(data_csv, targets_bottom, targets_top)
 
-    def loadData(self, data_csv, targets_bottom=None, targets_top=None):
+        if results_filter is not None:
+            results_filter.checkResolved()
+
+        if data_csv is None:
+            pass
+        elif columnar:
+            self.loadColumns(data_csv, targets_bottom, targets_top, label_prefix, results_filter)
+        elif isinstance(data_csv, str) and label_prefix is None:
+            self.loadData(data_csv, targets_bottom, targets_top, results_filter)
+        else:
+            print("ERROR: collated results need columnar loading", file=sys.stderr)
+            sys.exit(1)
+
+        labels = dict.fromkeys(ident[1] for ident in self.ident_count)
+        self.target_layout = TargetLayout(self.targets_top, self.targets_bottom, labels)
+
+    def loadData(self, data_csv, targets_bottom=None, targets_top=None, results_filter=None):
+        self.invalidateStats()
+
         # We're not using a dictreader here as we can't guarantee there will
         # be a header row present.
         with open(data_csv, 'r') as csvfile:
             self.raw_data = list(csv.reader(csvfile, delimiter=','))
+        self.num_rows = len(self.raw_data)
 
         # keep a record of the previous row values and remove duplicates (if
         # that's what we want) as this means the eye tracker did not get any
@@ -127,17 +488,23 @@ class ExperimentResults:
                 continue
 
             subject = row[DATA_COLS["Subject"]]
+            if results_filter is not None and not results_filter.includesRow(subject, row[DATA_COLS["Label"]],
+                                                                             int(row[DATA_COLS["Target-ID"]])):
+                continue
+
             if not subject in self.subject_data:
                 self.subject_data[subject] = {}
 
             # select the targets based on the CSV label
-            self.position = row[DATA_COLS["Label"]] # bottom or top
-            if not (self.position.endswith("bottom") or self.position.endswith("top")):
-                print("Not top or bottom - using all targets:", self.position)
+            self.default_label = row[DATA_COLS["Label"]] # bottom or top
+            if not (self.default_label.endswith("bottom") or self.default_label.endswith("top")):
+                print("Not top or bottom - using all targets:", self.default_label)
 
             targets = targets_top
-            if self.position.endswith("bottom"):
+            found_targets = self.targets_top
+            if self.default_label.endswith("bottom"):
                 targets = targets_bottom
+                found_targets = self.targets_bottom
 
             # extract the targets
             target_id = int(row[DATA_COLS["Target-ID"]])
@@ -149,16 +516,16 @@ class ExperimentResults:
             target_coords = (int(row[DATA_COLS["Target-X"]]),\
                             int(row[DATA_COLS["Target-Y"]]))
 
-            if target_id in self.getTargets():
+            if target_id in found_targets:
                 # make sure the data is consistent
-                if self.getTargets()[target_id] != target_coords:
+                if found_targets[target_id] != target_coords:
                     print("ERROR: inconsintent data for target " + str(target_id)\
-                          + ": coords recorded at " + str(self.getTargets()[target_id])\
+                          + ": coords recorded at " + str(found_targets[target_id])\
                           + " and " + str(target_coords))
                     sys.exit(1)
             else:
                 print("Adding target:", target_id)
-                self.getTargets()[target_id] = target_coords
+                found_targets[target_id] = target_coords
 
             # extract subject data
             identifier = (row[DATA_COLS["Tracker"]], row[DATA_COLS["Label"]])
@@ -222,120 +589,456 @@ class ExperimentResults:
             else:
                 self.subject_data[subject][identifier] = [coords]
 
-    def getTargets(self):
-        if not (self.position.endswith("bottom") or self.position.endswith("top")):
-                print("Not top or bottom - using all targets:", self.position)
+    # Same as loadData, but the file is parsed into numpy columns and the
+    # counts are done per column rather than per row. The valid samples are
+    # kept in a SampleStore, and subject_data is a read only view of it.
+    def loadColumns(self, data_csv, targets_bottom=None, targets_top=None, label_prefix=None, results_filter=None):
+        self.invalidateStats()
+        self.samples = SampleStore()
+        self.subject_data = SubjectDataView(self.samples)
 
-        if self.position.endswith("bottom"):
-            return self.targets_bottom
-
-        return self.targets_top
+        if isinstance(data_csv, str) and label_prefix is None:
+            columns, header_rows, self.num_rows = loadResultsColumns(data_csv, results_filter=results_filter)
+        else:
+            data_csvs = [data_csv] if isinstance(data_csv, str) else data_csv
+            columns, header_rows, self.num_rows = collateResultsColumns(data_csvs, label_prefix, results_filter)
+        self.invalid_rows.update(header_rows.tolist())
+        print("Ignoring " + str(len(header_rows)) + " header rows")
+
+        if len(columns["Row"]) == 0:
+            return
+
+        # subjects are added in order, even if all of their data is filtered
+        subjects, subject_codes = factorize(columns["Subject"])
+        for subject in subjects:
+            self.samples.addSubject(subject)
+
+        # select the targets based on the CSV label
+        labels, label_codes = factorize(columns["Label"])
+        for label in labels:
+            if not (label.endswith("bottom") or label.endswith("top")):
+                print("Not top or bottom - using all targets:", label)
+
+        self.default_label = columns["Label"][-1]
+        last_rows = len(subject_codes) - 1 - np.unique(subject_codes[::-1], return_index=True)[1]
+        for subject, row in zip(subjects, last_rows):
+            self.subject_last_label[subject] = columns["Label"][row]
+
+        bottom = np.array([label.endswith("bottom") for label in labels])[label_codes]
+
+        # if we're looking at a subset of targets, filter them here
+        keep = np.ones(len(bottom), dtype=bool)
+        for targets, in_position in ((targets_top, ~bottom), (targets_bottom, bottom)):
+            if targets is not None:
+                keep &= ~in_position | np.isin(columns["Target-ID"], list(targets))
+
+        # the bad eyes for every row, from the validity masks
+        num_loaded = len(columns["Row"])
+        bad_masks = badSideMasks(columns)
+
+        trackers, tracker_codes = factorize(columns["Tracker"])
+        ident_keys = tracker_codes[keep] * len(labels) + label_codes[keep]
+        subject_codes = subject_codes[keep]
+        bottom = bottom[keep]
+        columns = {name: col[keep] for name, col in columns.items() if not name.startswith("Valid-")}
+        target_id = columns["Target-ID"]
+        rows = columns["Row"]
+
+        if len(rows) == 0:
+            return
+
+        # extract the targets, making sure the data is consistent
+        for targets, in_position in ((self.targets_top, ~bottom), (self.targets_bottom, bottom)):
+            ids, first, inverse = np.unique(target_id[in_position], return_index=True, return_inverse=True)
+            target_x = columns["Target-X"][in_position]
+            target_y = columns["Target-Y"][in_position]
+
+            inconsistent = np.flatnonzero((target_x != target_x[first][inverse]) |\
+                                          (target_y != target_y[first][inverse]))
+            if len(inconsistent) > 0:
+                i = inconsistent[0]
+                print("ERROR: inconsintent data for target " + str(target_id[in_position][i])\
+                      + ": coords recorded at " + str((target_x[first][inverse][i], target_y[first][inverse][i]))\
+                      + " and " + str((target_x[i], target_y[i])))
+                sys.exit(1)
+
+            for i in np.argsort(first):
+                target_coords = (int(target_x[first[i]]), int(target_y[first[i]]))
+                if int(ids[i]) in targets:
+                    if targets[int(ids[i])] != target_coords:
+                        print("ERROR: inconsintent data for target " + str(ids[i])\
+                              + ": coords recorded at " + str(targets[int(ids[i])])\
+                              + " and " + str(target_coords))
+                        sys.exit(1)
+                else:
+                    print("Adding target:", int(ids[i]))
+                    targets[int(ids[i])] = target_coords
+
+        # the order each subject's targets first appear in, for views of the
+        # results (see select)
+        num_targets = int(target_id.max()) + 1
+        for side, in_position in enumerate((~bottom, bottom)):
+            keys, first = np.unique(subject_codes[in_position] * num_targets + target_id[in_position], return_index=True)
+            for key in keys[np.argsort(first)].tolist():
+                self.subject_targets.setdefault(subjects[key // num_targets], ([], []))[side].append(key % num_targets)
+
+        # extract subject data
+        ident_keys, ident_codes = factorize(ident_keys.tolist())
+        idents = [(trackers[k // len(labels)], labels[k % len(labels)]) for k in ident_keys]
+
+        # the counts are kept for each subject and identifier (and target),
+        # so the results can be split by subject (see select)
+        sid_keys, sid_codes = factorize((subject_codes * len(idents) + ident_codes).tolist())
+
+        # a header row means the next row we keep is from a new test
+        new_test = np.zeros(len(rows), dtype=bool)
+        next_row = np.searchsorted(rows, header_rows)
+        new_test[next_row[next_row < len(rows)]] = True
+        test_counts = np.bincount(sid_codes[new_test], minlength=len(sid_keys))
+
+        pair_keys, pair_codes = factorize((sid_codes * num_targets + target_id).tolist())
+        pair_counts = np.bincount(pair_codes, minlength=len(pair_keys))
+
+        # We have two readings for x and y. Average if they are valid, or
+        # use the best if only one is valid. If both invalid then keep
+        # as an invalid reading.
+        gaze_x = columns["Gaze-X"]
+        gaze_y = columns["Gaze-Y"]
+
+        # count the bad rows for each subject and identifier, and each target
+        # (filtered rows are left out)
+        bad_counts = np.zeros((len(sid_keys), 3), dtype=np.int64)
+        target_bad_counts = np.zeros((len(pair_keys), 3), dtype=np.int64)
+        for counts, codes in ((bad_counts, sid_codes), (target_bad_counts, pair_codes)):
+            loaded_codes = np.full(num_loaded, -1, dtype=np.int64)
+            loaded_codes[keep] = codes
+            for side in (BAD_RIGHT, BAD_LEFT, BAD_BOTH):
+                counts[:, side] = groupedPopcount(bad_masks[side], num_loaded, loaded_codes, len(counts))
+
+        invalid = unpackMask(bad_masks[BAD_BOTH], num_loaded)[keep]
+        self.invalid_rows.update(rows[invalid].tolist())
+        print("Ignoring " + str(np.count_nonzero(invalid)) + " rows of invalid data")
+
+        if REMOVE_DUPLICATE_READINGS:
+            # only the first of a run of identical readings is kept
+            valid = np.flatnonzero(~invalid)
+            duplicate = np.zeros(len(valid), dtype=bool)
+            duplicate[1:] = (gaze_x[valid][1:] == gaze_x[valid][:-1]) &\
+                            (gaze_y[valid][1:] == gaze_y[valid][:-1])
+            duplicate = valid[duplicate]
+
+            print("Ignoring " + str(len(duplicate)) + " rows of duplicate data")
+            self.invalid_rows.update(rows[duplicate].tolist())
+            bad_counts[:, BAD_BOTH] += np.bincount(sid_codes[duplicate], minlength=len(sid_keys))
+            invalid[duplicate] = True
+
+        sids = [(subjects[key // len(idents)], idents[key % len(idents)]) for key in sid_keys]
+        for sid, tests, bad in zip(sids, test_counts.tolist(), bad_counts.tolist()):
+            self.subject_counts[sid] = [tests] + bad
+            self.subject_target_counts[sid] = {}
+
+        for key, records, bad in zip(pair_keys, pair_counts.tolist(), target_bad_counts.tolist()):
+            self.subject_target_counts[sids[key // num_targets]][key % num_targets] = [records] + bad
+
+        for sid in sids:
+            self.addSubjectCounts(self.subject_counts[sid], self.subject_target_counts[sid], sid[1])
+
+        # the identifiers for each subject, in the order they first appear
+        valid = np.flatnonzero(~invalid)
+        group_keys, _ = factorize((subject_codes[valid] * len(idents) + ident_codes[valid]).tolist())
+        for key in group_keys:
+            self.samples.addSubjectIdentifier(subjects[key // len(idents)], idents[key % len(idents)])
+
+        # keep the valid samples per identifier
+        order = valid[np.argsort(ident_codes[valid], kind="stable")]
+        bounds = np.cumsum(np.bincount(ident_codes[valid], minlength=len(idents)))
+        for identifier, start, end in zip(idents, np.concatenate(([0], bounds[:-1])), bounds):
+            rows = order[start:end]
+            self.samples.addIdentifier(identifier, columns["Subject"][rows], target_id[rows],
+                                       gaze_x[rows], gaze_y[rows], columns["Timestamp"][rows])
+
+    # add the counts for one subject (from subject_counts and
+    # subject_target_counts) to the counts for the identifier
+    def addSubjectCounts(self, counts, target_counts, identifier):
+        self.ident_count[identifier] = self.ident_count.get(identifier, 0) + counts[0]
+        self.bad_data[identifier] = [x + y for x, y in zip(self.bad_data.get(identifier, [0,0,0]), counts[1:])]
+
+        ident_targets = self.ident_count_target.setdefault(identifier, {})
+        ident_target_bad = self.target_bad_data.setdefault(identifier, {})
+        for target, target_counts in target_counts.items():
+            ident_targets[target] = ident_targets.get(target, 0) + target_counts[0]
+            ident_target_bad[target] = [x + y for x, y in zip(ident_target_bad.get(target, [0,0,0]), target_counts[1:])]
+
+    # A view of the results for some of the subjects, the same as if only
+    # their results files had been collated (in the given order), but sharing
+    # the loaded samples and counts rather than loading them again.
+    # label_prefix is added to the start of each label as in
+    # collateResultsColumns, and can be a list with a prefix for each subject
+    # (the same subject can be given more than once with different prefixes).
+    # Columnar loading only.
+    def select(self, subjects, label_prefix=None):
+        if self.samples is None:
+            print("ERROR: selecting subjects needs columnar loading", file=sys.stderr)
+            sys.exit(1)
+
+        label_prefixes = label_prefix
+        if not isinstance(label_prefix, list):
+            label_prefixes = [label_prefix] * len(subjects)
+
+        view = ExperimentResults(None, self.plot_size)
+
+        # subjects which weren't loaded wouldn't be in the collated results
+        selected = [(str(s), prefix) for s, prefix in zip(subjects, label_prefixes)\
+                    if str(s) in self.samples.subject_idents]
+
+        # the targets are listed in the order they would be found in the
+        # collated results
+        for subject, prefix in selected:
+            top, bottom = self.subject_targets.get(subject, ([], []))
+            for targets, view_targets, ids in ((self.targets_top, view.targets_top, top),
+                                                (self.targets_bottom, view.targets_bottom, bottom)):
+                for target_id in ids:
+                    view_targets[target_id] = targets[target_id]
+
+            view.default_label = (prefix or "") + self.subject_last_label[subject]
+
+        subject_idents = []
+        for subject, prefix in selected:
+            for sid in self.subject_counts:
+                if sid[0] != subject:
+                    continue
 
-    def getStats(self, subject=None, identifier=None, distance_cm=None, participant=None):
-        if self.stats is not None:
+                identifier = sid[1] if prefix is None else (sid[1][0], prefix + sid[1][1])
+                view.addSubjectCounts(self.subject_counts[sid], self.subject_target_counts[sid], identifier)
+
+            for ident in self.samples.subject_idents[subject]:
+                identifier = ident if prefix is None else (ident[0], prefix + ident[1])
+                subject_idents.append((subject, ident, identifier))
+
+        view.samples = self.samples.select(list(dict.fromkeys(s for s, _ in selected)), subject_idents)
+        view.subject_data = SubjectDataView(view.samples)
+        view.target_layout = TargetLayout(view.targets_top, view.targets_bottom,
+                                          dict.fromkeys(ident[1] for ident in view.ident_count))
+        return view
+
+    # Split the results into views (see select), e.g. by Qualtrics answers
+    # with ResultsFilter.qualtricsGroups. groups maps a name to the subjects
+    # in that group. If prefix_labels is True, the labels in each group are
+    # prefixed with "<name> - ", as for the category plots.
+    def splitBy(self, groups, prefix_labels=False):
+        return OrderedDict((name, self.select(subjects, name + " - " if prefix_labels else None))\
+                           for name, subjects in groups.items())
+
+    # target ID -> (x, y) for the label (read only)
+    def getTargets(self, label):
+        return self.target_layout.getTargets(label)
+
+    # The valid samples for each of the identifiers as flat arrays, along with
+    # an array giving the index (into idents) of the identifier of each sample.
+    def getSampleArrays(self, idents, subject=None):
+        ident_codes = []
+        target_ids = []
+        x_pos = []
+        y_pos = []
+        for i, ident in enumerate(idents):
+            if self.samples is not None:
+                ident_target_ids, ident_x, ident_y = self.samples.getSamples(ident, subject)
+                target_ids.append(ident_target_ids.astype(np.int64))
+                x_pos.append(ident_x.astype(np.float64))
+                y_pos.append(ident_y.astype(np.float64))
+            else:
+                # loaded row by row, so use the subject data
+                # coords is in the format (target_id, x_pos, y_pos)
+                coords = [c for subj in self.subject_data if subject in (None, subj)\
+                          for c in self.subject_data[subj].get(ident, [])]
+                coords = np.array(coords, dtype=np.float64).reshape(-1, 3)
+                target_ids.append(coords[:, 0].astype(np.int64))
+                x_pos.append(coords[:, 1])
+                y_pos.append(coords[:, 2])
+            ident_codes.append(np.full(len(target_ids[-1]), i, dtype=np.int64))
+
+        if len(idents) == 0:
+            return (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0), np.zeros(0))
+
+        return (np.concatenate(ident_codes), np.concatenate(target_ids),
+                np.concatenate(x_pos), np.concatenate(y_pos))
+
+    # Stats are cached per set of arguments, so repeated calls (e.g. for each
+    # subject in turn) only calculate them once. The cache is cleared when
+    # data is loaded. Note that the returned stats are shared between calls.
+    # targets gives the (top, bottom) target IDs to include (see targetMask),
+    # which gives the same stats as loading only those targets.
+    def getStats(self, subject=None, identifier=None, distance_cm=None, participant=None, targets=None):
+        key = (subject, identifier, distance_cm, participant, targetMask(targets))
+        if key in self.stats_cache:
+            self.stats_cache.move_to_end(key)
+            self.stats = self.stats_cache[key]
             return self.stats
 
-        self.stats = {}
+        self.stats = self.calculateStats(subject, identifier, distance_cm, participant, targets)
 
-        # collect all of the stats in a larger dictionary to allow multiple
-        # subjects to be included
-        distances = {}
-        targetdist = {}
+        self.stats_cache[key] = self.stats
+        while len(self.stats_cache) > STATS_CACHE_SIZE:
+            self.stats_cache.popitem(last=False)
 
+        return self.stats
+
+    def invalidateStats(self):
+        self.stats = None
+        self.stats_cache.clear()
+        self.distances.clear()
+        self.aggregates.clear()
+
+    # The distance from the target for every valid sample, as flat arrays
+    # along with the identifier (index into idents) and target of each. These
+    # are kept until data is loaded again, so they can be shared (e.g. with
+    # CollatedStats) without being calculated twice.
+    def getTargetDistances(self, subject=None, identifier=None):
+        key = (subject, identifier)
+        if key in self.distances:
+            return self.distances[key]
+
+        # collect all of the samples in one set of arrays to allow multiple
+        # subjects to be included
+        idents = []
         for subj in self.subject_data:
-            if subj not in self.stats:
-                if subject is not None and subject != subj:
-                    continue
+            if subject is not None and subject != subj:
+                continue
 
             for ident in self.subject_data[subj]:
                 if identifier is not None and identifier != ident:
                     continue
 
-                if ident not in distances:
-                    distances[ident] = []
-
-                if ident not in targetdist:
-                    targetdist[ident] = {}
+                if ident not in idents:
+                    idents.append(ident)
+
+        ident_codes, target_ids, x_pos, y_pos = self.getSampleArrays(idents, subject)
+
+        # look up the target coords for every sample, using the target subset
+        # for the position of each identifier
+        num_targets = max(int(target_ids.max()) + 1 if len(target_ids) > 0 else 0, self.target_layout.num_targets)
+        target_coords = self.target_layout.lookupCoords([ident[1] for ident in idents], ident_codes, target_ids)
+
+        missing = np.isnan(target_coords[:, 0])
+        for code in np.unique(ident_codes[missing] * num_targets + target_ids[missing]):
+            print("WARN: not including target", code % num_targets, "for", idents[code // num_targets])
+
+        ident_codes = ident_codes[~missing]
+        target_ids = target_ids[~missing]
+
+        # use pythagoras to determine the distance
+        distances = np.sqrt((target_coords[~missing, 0] - x_pos[~missing]) ** 2\
+                          + (target_coords[~missing, 1] - y_pos[~missing]) ** 2)
+
+        self.distances[key] = (idents, ident_codes, target_ids, distances, num_targets)
+        return self.distances[key]
+
+    # The distances for each target of each identifier, with their exact sums
+    # (see GroupedStats.groupedSums) and the stats for the target. None of
+    # these depend on which other targets are included, so the stats for any
+    # set of targets can be put together from them. These are kept until data
+    # is loaded again.
+    def getTargetAggregates(self, subject=None, identifier=None):
+        key = (subject, identifier)
+        if key in self.aggregates:
+            return self.aggregates[key]
+
+        idents, ident_codes, target_ids, distances, num_targets = self.getTargetDistances(subject, identifier)
+
+        # group by identifier and target
+        target_groups, target_codes = np.unique(ident_codes * num_targets + target_ids, return_inverse=True)
+        sums = groupedSums(distances, target_codes, len(target_groups))
+        order, starts, counts = groupBounds(target_codes, len(target_groups))
+        target_distances = np.split(distances[order], starts[1:])
+        parametric = parametricFlags(distances, target_codes, len(target_groups))
+
+        # for accuracy, calculate the mean pixel distance from the target.
+        # for precision, we calculate the standard deviation.
+        target_stats = [combinedMeanPstdev([group_sums], dists) + (flag,)\
+                        for group_sums, dists, flag in zip(sums, target_distances, parametric)]
+
+        self.aggregates[key] = (idents, num_targets, target_groups, sums, target_distances, target_stats)
+        return self.aggregates[key]
+
+    def calculateStats(self, subject=None, identifier=None, distance_cm=None, participant=None, targets=None):
+        results = {}
+        mask = targetMask(targets)
+
+        idents, num_targets, target_groups, sums, target_distances, target_stats = self.getTargetAggregates(subject, identifier)
+
+        # we also convert this into degrees, if we have a working distance
+        conversion_factor = None
+        if distance_cm is not None:
+            conversion_factor = rad2deg(atan(PIXEL_SIZE_CM / distance_cm))
+
+        def fillStats(s, accuracy_px, precision_px, bad_data, test_n, record_n, parametric):
+            s.participant = participant
+            s.distance_cm = distance_cm
+            s.accuracy_px = float(accuracy_px)
+            s.precision_px = float(precision_px)
+            s.bad_data_right = bad_data[BAD_RIGHT]
+            s.bad_data_left = bad_data[BAD_LEFT]
+            s.bad_data_both = bad_data[BAD_BOTH]
+            s.test_n = test_n
+            s.record_n = record_n
+            s.parametric = parametric
 
-                # coords is in the format (target_id, x_pos, y_pos)
-                for coords in self.subject_data[subj][ident]:
-                    target_id = coords[0]
-                    x_pos = coords[1]
-                    y_pos = coords[2]
-
-                    # HACK: set the position to get the correct target subset
-                    self.position = ident[1]
-                    if target_id not in self.getTargets():
-                        print("WARN: not including target", target_id, "for", ident)
-                        continue
-
-                    # use pythagoras to determine the distance
-                    dist = sqrt((self.getTargets()[target_id][0] - x_pos) ** 2\
-                              + (self.getTargets()[target_id][1] - y_pos) ** 2)
-                    distances[ident].append(dist)
-
-                    if target_id not in targetdist[ident]:
-                        targetdist[ident][target_id] = []
-
-                    targetdist[ident][target_id].append(dist)
+            if conversion_factor is not None:
+                s.accuracy_deg = s.accuracy_px * conversion_factor
+                s.precision_deg = s.precision_px * conversion_factor
+
+        # the target groups for each identifier
+        ident_groups = [[] for _ in idents]
+        for group, key in enumerate(target_groups.tolist()):
+            if maskIncludes(mask, idents[key // num_targets][1], key % num_targets):
+                ident_groups[key // num_targets].append(group)
+
+        # the distances for each identifier, all tested for normality in one go
+        ident_distances = [np.concatenate([target_distances[group] for group in groups]) if len(groups) > 0\
+                           else np.empty(0) for groups in ident_groups]
+        parametric = parametricFlags(np.concatenate(ident_distances) if len(idents) > 0 else np.empty(0),
+                                     np.repeat(np.arange(len(idents)), [len(d) for d in ident_distances]),
+                                     len(idents))
+
+        for i, ident in enumerate(idents):
+            groups = ident_groups[i]
+            if len(groups) == 0:
+                print("WARN: no data for", ident)
+                continue
 
-        for ident in distances:
             label = subjectToLabel(ident)
 
-            if label in self.stats:
+            if label in results:
                 print("WARN: overwriting stats for " + label)
 
-            self.stats[label] = ExperimentStats()
+            # the counts for the included targets (including those without
+            # any valid data)
+            bad_data = self.bad_data[ident]
+            record_n = sum(self.ident_count_target[ident].values())
+            if mask is not None:
+                included = [t for t in self.ident_count_target[ident] if maskIncludes(mask, ident[1], t)]
+                bad_data = [sum(self.target_bad_data[ident][t][side] for t in included) for side in (BAD_RIGHT, BAD_LEFT, BAD_BOTH)]
+                record_n = sum(self.ident_count_target[ident][t] for t in included)
 
-            # for accuracy, calculate the mean pixel distance from the target.
-            # for precision, we calculate the standard deviation.
-            # we also convert this into degrees, if we have a working distance
+            dists = ident_distances[i]
+            accuracy, precision = combinedMeanPstdev([sums[group] for group in groups], dists)
 
-            conversion_factor = None
-            if distance_cm is not None:
-                conversion_factor = rad2deg(atan(PIXEL_SIZE_CM / distance_cm))
-
-            self.stats[label].participant = participant
-            self.stats[label].label = label
-            self.stats[label].distance_cm = distance_cm
-            self.stats[label].accuracy_px = mean(distances[ident])
-            self.stats[label].precision_px = pstdev(distances[ident])
-            self.stats[label].bad_data_right = self.bad_data[ident][BAD_RIGHT]
-            self.stats[label].bad_data_left = self.bad_data[ident][BAD_LEFT]
-            self.stats[label].bad_data_both = self.bad_data[ident][BAD_BOTH]
-            self.stats[label].test_n = self.ident_count[ident]
-            self.stats[label].parametric = ("True" if stats.kstest(distances[ident], 'norm').pvalue >= 0.05 else "False")
-
-            self.stats[label].record_n = 0
-            for target_id in self.ident_count_target[ident]:
-                self.stats[label].record_n += self.ident_count_target[ident][target_id]
-
-            if conversion_factor is not None:
-                self.stats[label].accuracy_deg = self.stats[label].accuracy_px * conversion_factor
-                self.stats[label].precision_deg = self.stats[label].precision_px * conversion_factor
+            results[label] = ExperimentStats()
+            results[label].label = label
+            fillStats(results[label], accuracy, precision, bad_data, self.ident_count[ident], record_n, parametric[i])
 
             # add the target stats too
-            if ident in targetdist:
-                for target_id in sorted(targetdist[ident]):
-                    if target_id not in self.stats[label].targets:
-                        self.stats[label].targets[target_id] = ExperimentStats()
-                    self.stats[label].targets[target_id].participant = participant
-                    self.stats[label].targets[target_id].label = label
-                    self.stats[label].targets[target_id].distance_cm = distance_cm
-                    self.stats[label].targets[target_id].target = target_id
-                    self.stats[label].targets[target_id].accuracy_px = mean(targetdist[ident][target_id])
-                    self.stats[label].targets[target_id].precision_px = pstdev(targetdist[ident][target_id])
-                    self.stats[label].targets[target_id].bad_data_right = self.target_bad_data[ident][target_id][BAD_RIGHT]
-                    self.stats[label].targets[target_id].bad_data_left = self.target_bad_data[ident][target_id][BAD_LEFT]
-                    self.stats[label].targets[target_id].bad_data_both = self.target_bad_data[ident][target_id][BAD_BOTH]
-                    self.stats[label].targets[target_id].test_n = self.ident_count[ident]
-                    self.stats[label].targets[target_id].record_n = self.ident_count_target[ident][target_id]
-                    self.stats[label].targets[target_id].parametric = ("True" if stats.kstest(targetdist[ident][target_id], 'norm').pvalue >= 0.05 else "False")
-
-                    if conversion_factor is not None:
-                        self.stats[label].targets[target_id].accuracy_deg = self.stats[label].targets[target_id].accuracy_px * conversion_factor
-                        self.stats[label].targets[target_id].precision_deg = self.stats[label].targets[target_id].precision_px * conversion_factor
-
-        return self.stats
+            for group in groups:
+                target_id = int(target_groups[group] % num_targets)
+                if target_id not in results[label].targets:
+                    results[label].targets[target_id] = ExperimentStats()
+                results[label].targets[target_id].label = label
+                results[label].targets[target_id].target = target_id
+                fillStats(results[label].targets[target_id], target_stats[group][0], target_stats[group][1],
+                          self.target_bad_data[ident][target_id], self.ident_count[ident],
+                          self.ident_count_target[ident][target_id],
+                          target_stats[group][2])
+
+        return results
 
 # EOF
@@ -0,0 +1,167 @@
+# Statistical tests comparing groups of values. Any number of comparisons are
+# run in one go and the results come back as one table (a pandas DataFrame)
+# with a row for each group, test and posthoc pair, so they can be saved and
+# read back directly rather than scraped from the printed stats. The numbers
+# in the table are exactly those returned by scipy, so a report printed from
+# the table is the same as one printed from the tests. The test results are
+# cached between runs (see TestCache).
+
+import numpy as np
+import pandas as pd
+from scikit_posthocs import posthoc_dunn
+from scipy import stats
+from statistics import median, pstdev
+
+import Resampling
+from TestCache import cachedTest
+
+SIGNIFICANCE = 0.05
+CONFIDENCE = 0.95
+
+# tests (the "test" column)
+DESCRIBE = "describe" # summary and confidence interval of one group
+MANN_WHITNEY = "mannwhitneyu" # two groups
+KRUSKAL = "kruskal" # more than two groups
+DUNN = "dunn" # posthoc Dunn test (Bonferroni) of a pair of groups, after KRUSKAL
+CHI_SQUARE = "chisquare" # one column of a table of counts
+PERMUTATION = Resampling.PERMUTATION # permutation test of the groups, with MANN_WHITNEY or KRUSKAL
+
+# Every table has these columns, after the columns of the comparison keys.
+# comparison is the index of the comparison, and group/other name the groups
+# in the row (other is the second group of a DUNN pair). column is the column
+# of the counts for CHI_SQUARE. resamples is the number of resamples for
+# PERMUTATION, and boot_ci_low/boot_ci_high the bootstrap confidence interval
+# of the mean for DESCRIBE (see Resampling).
+COLUMNS = ["comparison", "test", "group", "other", "column", "n", "statistic", "pvalue", "df", "resamples",
+           "min", "max", "mean", "median", "variance", "sd", "skewness", "kurtosis", "sem", "ci_low", "ci_high",
+           "boot_ci_low", "boot_ci_high"]
+
+# the columns which hold counts. The rest after "n" are floats, and the key
+# and name columns keep their values as they are.
+COUNT_COLUMNS = ("comparison", "n", "df", "resamples")
+
+def describeGroup(values, confidence):
+    if len(values) == 0:
+        return {"n": 0}
+
+    details = stats.describe(values)
+    sem = stats.sem(values)
+    ci = stats.t.interval(confidence, len(values) - 1, loc=details.mean, scale=sem)
+    return {"n": details.nobs, "min": details.minmax[0], "max": details.minmax[1], "mean": details.mean,
+            "median": median(values), "variance": details.variance, "sd": pstdev(values),
+            "skewness": details.skewness, "kurtosis": details.kurtosis, "sem": sem, "ci_low": ci[0], "ci_high": ci[1]}
+
+# the test to compare groups with, if it isn't given
+def defaultTest(groups):
+    if len(groups) == 2:
+        return MANN_WHITNEY
+    elif len(groups) > 2:
+        return KRUSKAL
+
+    return DESCRIBE
+
+# comparisons is a list of (key, groups[, test]), see runTests
+def groupTestRows(comparisons, confidence, first_comparison, resamples, seed, workers):
+    rows = []
+    described = {}
+    resampled = [] # (row, resampling job), filled in once the batch has run
+    for index, comparison in enumerate(comparisons, first_comparison):
+        key, groups = comparison[:2]
+        test = comparison[2] if len(comparison) > 2 else defaultTest(groups)
+
+        def addRow(test, **columns):
+            rows.append(dict(key, comparison=index, test=test, **columns))
+
+        for name, values in groups.items():
+            if not id(values) in described:
+                described[id(values)] = (values, cachedTest(DESCRIBE, describeGroup, values, confidence))
+            addRow(DESCRIBE, group=name, **described[id(values)][1])
+            if resamples > 0 and len(values) > 0:
+                resampled.append((rows[-1], (Resampling.BOOTSTRAP, [values])))
+
+        names = list(groups.keys())
+        values = list(groups.values())
+        n = sum(len(v) for v in values)
+        if test == MANN_WHITNEY:
+            result = cachedTest(MANN_WHITNEY, stats.mannwhitneyu, *values)
+            addRow(MANN_WHITNEY, n=n, statistic=result.statistic, pvalue=result.pvalue)
+        elif test == KRUSKAL:
+            result = cachedTest(KRUSKAL, stats.kruskal, *values)
+            addRow(KRUSKAL, n=n, statistic=result.statistic, pvalue=result.pvalue, df=len(values) - 1)
+
+        if resamples > 0 and test in (MANN_WHITNEY, KRUSKAL):
+            addRow(PERMUTATION, n=n, df=sum(len(v) > 0 for v in values) - 1, resamples=resamples)
+            resampled.append((rows[-1], (PERMUTATION, values)))
+
+        if test == KRUSKAL:
+            dunn = cachedTest(DUNN, posthoc_dunn, values, p_adjust='bonferroni').to_numpy()
+            for i, j in np.ndindex(dunn.shape):
+                addRow(DUNN, group=names[i], other=names[j], pvalue=dunn[i, j])
+
+    results = Resampling.runResampling([job for row, job in resampled], resamples, seed, confidence, workers)
+    for (row, (kind, groups)), result in zip(resampled, results):
+        if kind == PERMUTATION:
+            row["statistic"], row["pvalue"] = result
+        else:
+            row["boot_ci_low"], row["boot_ci_high"] = result[1:]
+
+    return rows
+
+# tables is a list of (key, counts, columns), see runTests
+def chiSquareRows(tables, first_comparison):
+    rows = []
+    for index, (key, counts, columns) in enumerate(tables, first_comparison):
+        result = cachedTest(CHI_SQUARE, stats.chisquare, list(counts.values()))
+        totals = np.sum(list(counts.values()), axis=0)
+        for i, column in enumerate(columns):
+            rows.append(dict(key, comparison=index, test=CHI_SQUARE, column=column, n=totals[i],
+                             statistic=result.statistic[i], pvalue=result.pvalue[i], df=len(counts) - 1))
+
+    return rows
+
+# Run the tests for a batch of comparisons, returning them as one table.
+#
+# comparisons is a list of (key, groups[, test]): key is a dict of extra
+# columns which identify the comparison (e.g. {"stat": "Accuracy", "label":
+# "top"}) and groups maps each group name to its values. Each comparison gets
+# a DESCRIBE row for each group, then the test: MANN_WHITNEY, or KRUSKAL and
+# a DUNN row for each pair of groups, or DESCRIBE for no test. Without a test,
+# MANN_WHITNEY is used for two groups and KRUSKAL for more than two. A list of
+# values which is in more than one comparison is only described once.
+#
+# tables is a list of (key, counts, columns) for chi-square tests (see
+# scipy.stats.chisquare): counts maps each group name to its counts, and
+# columns names the columns of the counts. Each column of counts gets a
+# CHI_SQUARE row.
+#
+# With resamples, each comparison with a test also gets a PERMUTATION row,
+# and each DESCRIBE row a bootstrap confidence interval, from that many
+# resamples (see Resampling.runResampling for seed and workers).
+#
+# The comparison column of the comparisons counts up from 0, followed by the
+# tables.
+def runTests(comparisons=(), tables=(), confidence=CONFIDENCE, resamples=0, seed=Resampling.SEED, workers=1):
+    rows = groupTestRows(comparisons, confidence, 0, resamples, seed, workers) + chiSquareRows(tables, len(comparisons))
+    keys = list(dict.fromkeys(c for row in rows for c in row if not c in COLUMNS))
+    numeric = COLUMNS[COLUMNS.index("n"):]
+
+    columns = {}
+    for c in keys + COLUMNS:
+        values = [row.get(c) for row in rows]
+        if c in COUNT_COLUMNS:
+            columns[c] = pd.array(values, dtype="Int64")
+        elif c in numeric:
+            columns[c] = pd.array(values, dtype="float64")
+        else:
+            columns[c] = pd.array(values, dtype=object)
+
+    return pd.DataFrame(columns, columns=keys + COLUMNS)
+
+# the rows of the table for each comparison (as named tuples), by comparison index
+def comparisonRows(table):
+    rows = {}
+    for row in table.itertuples(index=False):
+        rows.setdefault(row.comparison, []).append(row)
+    return rows
+
+# EOF
@@ -0,0 +1,213 @@
+# Grouped reductions over flat numpy arrays. Each value is tagged with a group
+# number (0 to num_groups - 1) and the functions here return one result per
+# group, in group order. Empty groups give NaN.
+
+import math
+import numpy as np
+from scipy import special, stats
+from statistics import mean, pstdev
+
+# To give exactly the same answers as statistics.mean and statistics.pstdev
+# (which work with exact fractions), each value is split into integer limbs
+# and the sums are done on those. A group can span 68 bits, which is plenty
+# for pixel distances (e.g. 0.5px to 1000s of px at full float precision).
+# Groups which don't fit fall back to the statistics module.
+LIMB_BITS = 17
+NUM_LIMBS = 4
+MANTISSA_BITS = 53
+
+# normality tests (see groupedNormalityTest)
+KSTEST = "kstest" # Kolmogorov-Smirnov against the standard normal, as stats.kstest(values, 'norm')
+LILLIEFORS = "lilliefors" # Kolmogorov-Smirnov against a normal with the mean and sd of the values
+
+# the fewest values the Lilliefors p-value is given for
+LILLIEFORS_MIN_N = 5
+
+# sort order of the values, and where each group starts in that order
+def groupBounds(group_codes, num_groups):
+    group_codes = np.asarray(group_codes, dtype=np.int64)
+    order = np.argsort(group_codes, kind="stable")
+    counts = np.bincount(group_codes, minlength=num_groups)
+    starts = np.concatenate(([0], np.cumsum(counts)[:-1])).astype(np.int64)
+    return order, starts, counts
+
+# square root of n/m, correctly rounded (as statistics.pstdev does)
+def sqrtOfFraction(n, m):
+    # work with enough bits that rounding to odd then converting to a float
+    # gives the correctly rounded result
+    q = (n.bit_length() - m.bit_length() - 2 * MANTISSA_BITS - 3) // 2
+    if q >= 0:
+        m <<= 2 * q
+    else:
+        n <<= -2 * q
+
+    root = math.isqrt(n // m)
+    root |= (root * root * m != n) # round to odd
+    return root * 2.0 ** q if q >= 0 else root / (1 << -q)
+
+# The exact sums for each group, which can be combined with those of other
+# groups (see meanPstdevFromSums). Returns a list with (n, sum of x, sum of
+# x^2, low_bit) for each group, where the values are integers * 2^low_bit, or
+# None for empty groups and groups which don't fit.
+def groupedSums(values, group_codes, num_groups):
+    values = np.asarray(values, dtype=np.float64)
+    sums = [None] * num_groups
+
+    order, starts, counts = groupBounds(group_codes, num_groups)
+    groups = np.flatnonzero(counts)
+    if len(groups) == 0:
+        return sums
+
+    values = values[order]
+    starts = starts[groups]
+    counts = counts[groups]
+
+    # scale each group so its values are all integers
+    _, exponent = np.frexp(values)
+    low_bit = np.where(values != 0, exponent - MANTISSA_BITS, np.iinfo(np.int64).max)
+    group_low_bit = np.minimum.reduceat(low_bit, starts)
+    group_low_bit[group_low_bit == np.iinfo(np.int64).max] = 0
+    scaled = np.ldexp(values, -np.repeat(group_low_bit, counts))
+
+    fits = np.isfinite(scaled) & (scaled >= 0) & (scaled < 2.0 ** (LIMB_BITS * NUM_LIMBS))
+    group_fits = np.logical_and.reduceat(fits, starts)
+    scaled[~fits] = 0
+
+    limbs = []
+    for i in reversed(range(NUM_LIMBS)):
+        limb = np.floor(scaled / 2.0 ** (LIMB_BITS * i))
+        scaled -= limb * 2.0 ** (LIMB_BITS * i)
+        limbs.insert(0, limb.astype(np.int64))
+
+    limb_sums = [np.add.reduceat(limb, starts) for limb in limbs]
+    product_sums = {(i, j): np.add.reduceat(limbs[i] * limbs[j], starts)\
+                    for i in range(NUM_LIMBS) for j in range(i, NUM_LIMBS)}
+
+    for k, group in enumerate(groups):
+        if not group_fits[k]:
+            continue
+
+        # sum of x and x^2, as exact integers
+        sx = sum(int(limb_sums[i][k]) << (LIMB_BITS * i) for i in range(NUM_LIMBS))
+        sxx = sum(int(s[k]) << (LIMB_BITS * (i + j) + (i != j)) for (i, j), s in product_sums.items())
+        sums[group] = (int(counts[k]), sx, sxx, int(group_low_bit[k]))
+
+    return sums
+
+# The mean and population standard deviation of the values of a set of groups
+# combined, from their sums (as returned by groupedSums), exactly as
+# statistics.mean and statistics.pstdev would give them.
+def meanPstdevFromSums(sums):
+    low_bit = min(s[3] for s in sums)
+    n = sum(s[0] for s in sums)
+    sx = sum(s[1] << (s[3] - low_bit) for s in sums)
+    sxx = sum(s[2] << (2 * (s[3] - low_bit)) for s in sums)
+
+    if low_bit >= 0:
+        return (sx << low_bit) / n, sqrtOfFraction((n * sxx - sx * sx) << (2 * low_bit), n * n)
+
+    return sx / (n << -low_bit), sqrtOfFraction(n * sxx - sx * sx, (n * n) << (-2 * low_bit))
+
+# The mean and population standard deviation of a set of groups combined,
+# from their sums if they all fit, otherwise from all of their values.
+def combinedMeanPstdev(sums, values):
+    if all(group_sums is not None for group_sums in sums):
+        return meanPstdevFromSums(sums)
+
+    values = np.asarray(values, dtype=np.float64).tolist()
+    return mean(values), pstdev(values)
+
+# the mean and population standard deviation of each group, exactly as
+# statistics.mean and statistics.pstdev would give them
+def groupedMeanPstdev(values, group_codes, num_groups):
+    values = np.asarray(values, dtype=np.float64)
+    means = np.full(num_groups, np.nan)
+    pstdevs = np.full(num_groups, np.nan)
+
+    order, starts, counts = groupBounds(group_codes, num_groups)
+    for group, group_sums in enumerate(groupedSums(values, group_codes, num_groups)):
+        if group_sums is not None:
+            means[group], pstdevs[group] = meanPstdevFromSums([group_sums])
+        elif counts[group] > 0:
+            group_values = values[order[starts[group]:starts[group] + counts[group]]].tolist()
+            means[group] = mean(group_values)
+            pstdevs[group] = pstdev(group_values)
+
+    return means, pstdevs
+
+# Lilliefors p-values for the Kolmogorov-Smirnov statistics d of n values,
+# using the approximation of Dallal and Wilkinson (1986). This is accurate for
+# p-values below 0.1, which is all that's needed to compare to a significance
+# level, and an overestimate above that.
+def lillieforsPvalue(d, n):
+    d = np.where(n > 100, d * (np.maximum(n, 100) / 100.0) ** 0.49, d)
+    n = np.minimum(n, 100).astype(np.float64)
+    pvalue = np.exp(-7.01256 * d ** 2 * (n + 2.78019) + 2.99587 * d * np.sqrt(n + 2.78019)
+                    - 0.122119 + 0.974598 / np.sqrt(n) + 1.67997 / n)
+    return np.minimum(pvalue, 1.0)
+
+# The two sided Kolmogorov-Smirnov statistic of each group against a normal
+# distribution, and the number of values in each group. With standardize, the
+# values are compared to a normal with the mean and (sample) standard
+# deviation of their group, otherwise to the standard normal.
+def groupedKsStatistics(values, group_codes, num_groups, standardize=False):
+    values = np.asarray(values, dtype=np.float64)
+    group_codes = np.asarray(group_codes, dtype=np.int64)
+    statistics = np.full(num_groups, np.nan)
+
+    counts = np.bincount(group_codes, minlength=num_groups)
+    groups = np.flatnonzero(counts)
+    if len(groups) == 0:
+        return statistics, counts
+
+    # sort by group, then by value within each group
+    order = np.lexsort((values, group_codes))
+    values = values[order]
+    group_counts = counts[groups]
+    starts = np.concatenate(([0], np.cumsum(group_counts)[:-1]))
+    n = np.repeat(group_counts, group_counts).astype(np.float64)
+    rank = np.arange(len(values)) - np.repeat(starts, group_counts)
+
+    if standardize:
+        means = np.add.reduceat(values, starts) / group_counts
+        deviations = values - np.repeat(means, group_counts)
+        sd = np.sqrt(np.add.reduceat(deviations ** 2, starts) / np.maximum(group_counts - 1, 1))
+        with np.errstate(invalid="ignore", divide="ignore"): # NaN where every value is the same
+            values = deviations / np.repeat(sd, group_counts)
+
+    # as stats.kstest works them out, so the statistics are the same
+    cdf = special.ndtr(values)
+    d_plus = np.maximum.reduceat((rank + 1.0) / n - cdf, starts)
+    d_minus = np.maximum.reduceat(cdf - rank / n, starts)
+    statistics[groups] = np.maximum(d_plus, d_minus)
+    return statistics, counts
+
+# Test whether the values of each group are normally distributed, returning
+# the statistic and p-value for each group (NaN for empty groups). test is
+# KSTEST, which gives the same results as stats.kstest(values, 'norm') for
+# each group, or LILLIEFORS, which standardizes the values of each group first
+# so only their shape is tested (NaN for fewer than LILLIEFORS_MIN_N values).
+# With significance, p-values which are certainly below it aren't worked out
+# exactly (working out exact KSTEST p-values is slow) and are given as 0.
+def groupedNormalityTest(values, group_codes, num_groups, test=KSTEST, significance=None):
+    statistics, counts = groupedKsStatistics(values, group_codes, num_groups, standardize=(test == LILLIEFORS))
+    pvalues = np.full(num_groups, np.nan)
+
+    if test == LILLIEFORS:
+        groups = np.flatnonzero(counts >= LILLIEFORS_MIN_N)
+        pvalues[groups] = lillieforsPvalue(statistics[groups], counts[groups])
+    elif test == KSTEST:
+        groups = np.flatnonzero(counts)
+        if significance is not None:
+            # the Dvoretzky-Kiefer-Wolfowitz bound on the p-value, with a
+            # margin so rounding can't change the outcome
+            bound = 2 * np.exp(-2 * counts[groups] * statistics[groups] ** 2)
+            pvalues[groups[bound < significance / 2]] = 0.0
+            groups = groups[bound >= significance / 2]
+        pvalues[groups] = np.clip(stats.kstwo.sf(statistics[groups], counts[groups]), 0.0, 1.0)
+    else:
+        raise ValueError("unknown normality test: " + str(test))
+
+    return statistics, pvalues
+
+# EOF
@@ -0,0 +1,183 @@
+# Permutation tests and bootstrap confidence intervals for groups of values,
+# which don't assume anything about how the values are distributed (unlike
+# the Kruskal-Wallis and Mann-Whitney p-values and the t based confidence
+# intervals).
+#
+# The resamples are drawn as matrices, one row per resample (of bootstrap
+# indices, or of the ranks of the values shuffled between the groups), a chunk
+# of rows at a time so the memory used is bounded whatever the number of
+# resamples. The chunks from a whole batch of jobs can be run on a pool of
+# worker processes. Each job has its own random stream, seeded from the seed
+# and the job's values, and each chunk its own stream spawned from that, so
+# the results don't depend on the number of workers, on the other jobs in the
+# batch, or on which results came from the cache (see TestCache).
+
+from concurrent.futures import ProcessPoolExecutor
+import hashlib
+import multiprocessing
+import numpy as np
+from scipy.stats import rankdata
+
+from TestCache import inputHash, loadResult, saveResult
+
+RESAMPLES = 10000
+SEED = 0
+CONFIDENCE = 0.95
+
+# the largest number of values drawn at once (in rows of one resample each)
+CHUNK_VALUES = 1 << 21
+
+# kinds of job
+PERMUTATION = "permutation" # groups -> (statistic, pvalue)
+BOOTSTRAP = "bootstrap" # values -> (mean, ci_low, ci_high)
+
+# relative difference allowed when comparing statistics for permutation
+# p-values, so permutations giving the same statistic as the data count as
+# being at least as extreme despite rounding
+STATISTIC_TOLERANCE = 1e-12
+
+def jobSeed(kind, groups, seed):
+    h = hashlib.blake2b(digest_size=8)
+    h.update(kind.encode("utf-8"))
+    for values in groups:
+        values = np.ascontiguousarray(values, dtype=np.float64)
+        h.update((str(len(values)) + ";").encode("utf-8"))
+        h.update(values.tobytes())
+    return np.random.SeedSequence([seed, int.from_bytes(h.digest(), "little")])
+
+# the number of resamples in each chunk for n values per resample
+def chunkSizes(resamples, n):
+    rows = max(1, CHUNK_VALUES // max(n, 1))
+    return [min(rows, resamples - start) for start in range(0, resamples, rows)]
+
+# The Kruskal-Wallis statistic (with the correction for ties) for values
+# ranked as ranks, split into groups at starts, for each row of ranks.
+def rankStatistic(ranks, starts, counts, tie_correction):
+    n = ranks.shape[-1]
+    sums = np.add.reduceat(ranks, starts, axis=-1)
+    h = 12.0 / (n * (n + 1)) * np.sum(sums * sums / counts, axis=-1) - 3.0 * (n + 1)
+    return h / tie_correction
+
+def permutationSetup(groups):
+    counts = np.array([len(values) for values in groups], dtype=np.int64)
+    starts = np.concatenate(([0], np.cumsum(counts)[:-1])).astype(np.int64)
+    ranks = rankdata(np.concatenate([np.asarray(values, dtype=np.float64) for values in groups]))
+
+    n = len(ranks)
+    _, ties = np.unique(ranks, return_counts=True)
+    tie_correction = 1.0
+    if n > 1:
+        tie_correction = 1.0 - np.sum(ties.astype(np.float64) ** 3 - ties) / (float(n) ** 3 - n)
+    if tie_correction == 0: # every value is the same
+        tie_correction = 1.0
+
+    return ranks, starts, counts, tie_correction
+
+# the number of permutations in a chunk whose statistic is at least observed
+def permutationChunk(setup, observed, rows, seed_sequence):
+    ranks, starts, counts, tie_correction = setup
+    rng = np.random.default_rng(seed_sequence)
+    permuted = rng.permuted(np.broadcast_to(ranks, (rows, len(ranks))), axis=1)
+    statistics = rankStatistic(permuted, starts, counts, tie_correction)
+    return int(np.count_nonzero(statistics >= observed - abs(observed) * STATISTIC_TOLERANCE))
+
+# the means of a chunk of bootstrap resamples
+def bootstrapChunk(values, rows, seed_sequence):
+    values = np.asarray(values, dtype=np.float64)
+    rng = np.random.default_rng(seed_sequence)
+    indices = rng.integers(0, len(values), size=(rows, len(values)), dtype=np.int32)
+    return np.take(values, indices).sum(axis=1) / len(values)
+
+def runChunk(func, args):
+    return func(*args)
+
+# The chunks of work for a job, as (function, arguments), and a function to
+# put the results of the chunks together into the result of the job.
+def jobChunks(kind, groups, resamples, seed, confidence):
+    chunks = []
+    sizes = chunkSizes(resamples, sum(len(values) for values in groups))
+    seeds = jobSeed(kind, groups, seed).spawn(len(sizes))
+
+    if kind == PERMUTATION:
+        setup = permutationSetup(groups)
+        observed = float(rankStatistic(*setup))
+        for rows, seed_sequence in zip(sizes, seeds):
+            chunks.append((permutationChunk, (setup, observed, rows, seed_sequence)))
+
+        # the data counts as one of the permutations
+        def finish(results):
+            return (observed, (sum(results) + 1) / (resamples + 1))
+    elif kind == BOOTSTRAP:
+        values = groups[0]
+        for rows, seed_sequence in zip(sizes, seeds):
+            chunks.append((bootstrapChunk, (values, rows, seed_sequence)))
+
+        def finish(results):
+            means = np.concatenate(results)
+            low, high = np.percentile(means, [(1 - confidence) / 2 * 100, (1 + confidence) / 2 * 100])
+            return (float(np.mean(values)), float(low), float(high))
+    else:
+        raise ValueError("unknown resampling job: " + str(kind))
+
+    return chunks, finish
+
+# Run a batch of jobs, each (PERMUTATION, groups) or (BOOTSTRAP, [values]),
+# where groups is a list of lists of values. Returns the result of each job in
+# order:
+#   PERMUTATION: (statistic, pvalue) from comparing the Kruskal-Wallis
+#     statistic (with two groups, this is the same test as Mann-Whitney) to
+#     its value for resamples random permutations of the values between the
+#     groups. Empty groups are left out, and with fewer than two groups left
+#     both are NaN.
+#   BOOTSTRAP: (mean, ci_low, ci_high), the percentile confidence interval of
+#     the mean from resamples bootstrap resamples. NaN with no values.
+# Results are cached between runs, and a job which is in the batch more than
+# once is only run once. With more than one worker, the chunks of all of the
+# jobs are run on a pool of worker processes.
+def runResampling(jobs, resamples=RESAMPLES, seed=SEED, confidence=CONFIDENCE, workers=1):
+    results = [None] * len(jobs)
+    pending = [] # (job index, cache key, chunks, finish)
+    repeats = {} # job index -> index of the same job earlier in the batch
+    keys = {}
+    for index, (kind, groups) in enumerate(jobs):
+        groups = [np.asarray(values, dtype=np.float64) for values in groups if len(values) > 0]
+        if len(groups) < (2 if kind == PERMUTATION else 1):
+            results[index] = (np.nan, np.nan) if kind == PERMUTATION else (np.nan, np.nan, np.nan)
+            continue
+
+        key = inputHash(kind, groups, {"resamples": resamples, "seed": seed, "confidence": confidence,
+                                       "chunk_values": CHUNK_VALUES})
+        if key in keys:
+            repeats[index] = keys[key]
+            continue
+        keys[key] = index
+
+        found, results[index] = loadResult(key)
+        if not found:
+            pending.append((index, key) + jobChunks(kind, groups, resamples, seed, confidence))
+
+    tasks = [(index, chunk) for index, key, chunks, finish in pending for chunk in chunks]
+    chunk_results = {index: [] for index, key, chunks, finish in pending}
+    if workers <= 1 or len(tasks) <= 1:
+        for index, (func, args) in tasks:
+            chunk_results[index].append(func(*args))
+    else:
+        context = None
+        if "fork" in multiprocessing.get_all_start_methods():
+            context = multiprocessing.get_context("fork")
+
+        with ProcessPoolExecutor(max_workers=workers, mp_context=context) as pool:
+            futures = [(index, pool.submit(runChunk, func, args)) for index, (func, args) in tasks]
+            for index, future in futures:
+                chunk_results[index].append(future.result())
+
+    for index, key, chunks, finish in pending:
+        results[index] = finish(chunk_results[index])
+        saveResult(key, results[index])
+
+    for index, first in repeats.items():
+        results[index] = results[first]
+
+    return results
+
+# EOF
@@ -0,0 +1,117 @@
+# A cache of parsed results files. Each source CSV gets a directory holding
+# one .npy file per column, plus a JSON file recording the source file path,
+# size, modification time and content hash. Numeric columns are memory mapped
+# when loaded; text columns are stored as indices into a list of values.
+
+import hashlib
+import json
+import numpy as np
+import os
+import shutil
+
+# bump this whenever the cached columns change meaning
+CACHE_VERSION = 2
+
+# set to a directory to keep all cache entries in one place. If None, the
+# cache is kept in a CACHE_DIR_NAME directory next to each source file.
+RESULTS_CACHE_DIR = None
+CACHE_DIR_NAME = ".results_cache"
+
+META_FILE = "meta.json"
+
+def cachePath(data_csv):
+    data_csv = os.path.abspath(data_csv)
+    if RESULTS_CACHE_DIR is None:
+        return os.path.join(os.path.dirname(data_csv), CACHE_DIR_NAME, os.path.basename(data_csv))
+
+    path_hash = hashlib.sha1(data_csv.encode("utf-8")).hexdigest()[:16]
+    return os.path.join(RESULTS_CACHE_DIR, os.path.basename(data_csv) + "-" + path_hash)
+
+def contentHash(data_csv):
+    with open(data_csv, 'rb') as f:
+        return hashlib.blake2b(f.read(), digest_size=20).hexdigest()
+
+# Returns (arrays, info) as passed to saveCache, or None if there is no
+# valid cache entry for this file. If decode_text is False, text arrays are
+# returned as (unique values, memory mapped indices into them), so rows can be
+# selected before the text is looked up.
+def loadCache(data_csv, decode_text=True):
+    entry = cachePath(data_csv)
+    try:
+        with open(os.path.join(entry, META_FILE), 'r') as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return None
+
+    source = os.stat(data_csv)
+    if meta["version"] != CACHE_VERSION or meta["path"] != os.path.abspath(data_csv)\
+       or meta["size"] != source.st_size:
+        return None
+
+    # the file has been touched - only use the cache if the contents match
+    if meta["mtime_ns"] != source.st_mtime_ns:
+        if meta["hash"] != contentHash(data_csv):
+            return None
+
+        meta["mtime_ns"] = source.st_mtime_ns
+        try:
+            with open(os.path.join(entry, META_FILE), 'w') as f:
+                json.dump(meta, f)
+        except OSError:
+            pass
+
+    arrays = {}
+    try:
+        for name in meta["arrays"]:
+            values = np.load(os.path.join(entry, name + ".npy"), mmap_mode='r')
+            if name in meta["text"]:
+                uniques = meta["text"][name]
+                values = np.array(uniques, dtype=object)[values] if decode_text else (uniques, values)
+            arrays[name] = values
+    except (OSError, ValueError):
+        return None
+
+    return arrays, meta["info"]
+
+# Store the arrays for this file. Text (object) arrays are stored as indices
+# into their unique values, and 64 bit integers are stored as int32 where they
+# fit. info must be something json can write.
+def saveCache(data_csv, arrays, info):
+    entry = cachePath(data_csv)
+    meta = {
+        "version": CACHE_VERSION,
+        "path": os.path.abspath(data_csv),
+        "size": os.stat(data_csv).st_size,
+        "mtime_ns": os.stat(data_csv).st_mtime_ns,
+        "hash": contentHash(data_csv),
+        "arrays": list(arrays),
+        "text": {},
+        "info": info
+    }
+
+    # write to a temporary directory first so a half-written entry is never
+    # picked up by another process
+    temp_entry = entry + ".tmp" + str(os.getpid())
+    try:
+        os.makedirs(temp_entry, exist_ok=True)
+        for name, values in arrays.items():
+            if values.dtype == object:
+                uniques = list(dict.fromkeys(values.tolist()))
+                lookup = {v: i for i, v in enumerate(uniques)}
+                meta["text"][name] = uniques
+                values = np.fromiter(map(lookup.__getitem__, values), dtype=np.int32, count=len(values))
+            elif values.dtype.kind == 'i' and values.dtype.itemsize > 4 and len(values) > 0 and\
+                 np.iinfo(np.int32).min <= values.min() and values.max() <= np.iinfo(np.int32).max:
+                values = values.astype(np.int32)
+            np.save(os.path.join(temp_entry, name + ".npy"), values)
+
+        with open(os.path.join(temp_entry, META_FILE), 'w') as f:
+            json.dump(meta, f)
+
+        shutil.rmtree(entry, ignore_errors=True)
+        os.replace(temp_entry, entry)
+    except OSError as e:
+        print("WARN: could not write results cache for " + data_csv + ": " + str(e))
+        shutil.rmtree(temp_entry, ignore_errors=True)
+
+# EOF
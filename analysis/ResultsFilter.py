@@ -0,0 +1,192 @@
+# A description of which results data to load: participants, labels and
+# targets to include or leave out, and rules which leave out a participant's
+# data based on their Qualtrics answers. The loaders apply the filter as
+# early as they can, so excluded rows are dropped before the numbers are
+# converted and the eyes are combined, and (with the results cache) decided
+# from the cached labels and subjects without reading the other columns.
+
+from fnmatch import fnmatchcase
+import numpy as np
+import operator
+import sys
+
+from TargetLayout import TOP, BOTTOM, labelSide
+
+# comparisons allowed in Qualtrics rules. The numeric comparisons treat a
+# blank answer as 0.
+RULE_OPS = {
+    "like": lambda value, wildcard: isLike(value, wildcard),
+    "unlike": lambda value, wildcard: not isLike(value, wildcard),
+    "==": operator.eq,
+    "!=": operator.ne,
+    ">": operator.gt,
+    ">=": operator.ge,
+    "<": operator.lt,
+    "<=": operator.le
+}
+
+def isLike(value, wildcard):
+    return fnmatchcase(value.lower(), wildcard.lower())
+
+# participant IDs are the Subject values in the results (and the directory
+# names in a results tree), so they are compared as strings
+def participantKey(participant):
+    return str(participant)
+
+def ruleMatches(record, column, op, value):
+    answer = record.get(column) or ""
+    if op in ("like", "unlike"):
+        return RULE_OPS[op](answer, value)
+
+    return RULE_OPS[op](float(answer or 0), float(value))
+
+# Group participants by their Qualtrics answers (participant ID -> record).
+# groups maps a name to a wildcard for the column, or an (op, value) rule as in
+# RULE_OPS, e.g. {"mf": "*multifocal*", "sv": "*single vision*"}. Returns the
+# participant IDs in each group, in Qualtrics order, leaving out any not in
+# participants (if given).
+def qualtricsGroups(qualtrics, column, groups, participants=None):
+    if participants is not None:
+        participants = set(map(participantKey, participants))
+
+    grouped = {}
+    for name, rule in groups.items():
+        op, value = ("like", rule) if isinstance(rule, str) else rule
+        grouped[name] = [p for p, record in qualtrics.items()\
+                         if (participants is None or participantKey(p) in participants)\
+                         and ruleMatches(record, column, op, value)]
+
+    return grouped
+
+class ResultsFilter:
+    # participants: IDs to include (None for all)
+    # exclude_participants: IDs to leave out
+    # labels: label wildcards to include (None for all)
+    # exclude_labels: label wildcards to leave out for every participant
+    # exclude_participant_labels: participant ID -> label wildcards to leave out
+    # exclude_where: Qualtrics rules, (column, op, value, label wildcard). A
+    #   participant's labels matching the wildcard are left out if their
+    #   answer matches, e.g. ("Correction", "like", "*contact lens*", "*").
+    #   These need the Qualtrics answers, see resolve.
+    # targets_top/targets_bottom: target IDs to include for labels in each
+    #   position (None for all)
+    def __init__(self, participants=None, exclude_participants=(), labels=None, exclude_labels=(),
+                 exclude_participant_labels=None, exclude_where=(), targets_top=None, targets_bottom=None):
+        self.participants = None if participants is None else frozenset(map(participantKey, participants))
+        self.exclude_participants = frozenset(map(participantKey, exclude_participants))
+        self.labels = None if labels is None else tuple(labels)
+        self.exclude_labels = tuple(exclude_labels)
+        self.exclude_participant_labels = {participantKey(p): tuple(wildcards)\
+                                           for p, wildcards in (exclude_participant_labels or {}).items()}
+        self.exclude_where = tuple(tuple(rule) for rule in exclude_where)
+        self.targets = {TOP: None if targets_top is None else frozenset(targets_top),
+                        BOTTOM: None if targets_bottom is None else frozenset(targets_bottom)}
+
+        for column, op, value, wildcard in self.exclude_where:
+            if not op in RULE_OPS:
+                print("ERROR: unknown comparison in Qualtrics rule: " + str(op), file=sys.stderr)
+                sys.exit(1)
+
+    # everything which affects the rows selected, in a fixed order, so
+    # filters can be compared and used in build manifests
+    def key(self):
+        return (None if self.participants is None else sorted(self.participants),
+                sorted(self.exclude_participants),
+                self.labels,
+                self.exclude_labels,
+                sorted(self.exclude_participant_labels.items()),
+                self.exclude_where,
+                [None if self.targets[side] is None else sorted(self.targets[side]) for side in (TOP, BOTTOM)])
+
+    def __repr__(self):
+        return "ResultsFilter" + repr(self.key())
+
+    def __eq__(self, other):
+        return isinstance(other, ResultsFilter) and self.key() == other.key()
+
+    def __hash__(self):
+        return hash(repr(self))
+
+    # Apply the Qualtrics rules to the answers (participant ID -> record, as
+    # read by csv.DictReader), giving a filter with the rules replaced by the
+    # participants and labels they exclude. The rules only apply to
+    # participants with a record.
+    def resolve(self, qualtrics):
+        records = {participantKey(p): record for p, record in qualtrics.items()}
+        exclude_participants = set(self.exclude_participants)
+        exclude_participant_labels = {p: list(w) for p, w in self.exclude_participant_labels.items()}
+
+        for participant, record in records.items():
+            for column, op, value, wildcard in self.exclude_where:
+                if not ruleMatches(record, column, op, value):
+                    continue
+
+                if wildcard == "*":
+                    exclude_participants.add(participant)
+                elif wildcard not in exclude_participant_labels.get(participant, []):
+                    exclude_participant_labels.setdefault(participant, []).append(wildcard)
+
+        return ResultsFilter(self.participants, exclude_participants, self.labels, self.exclude_labels,
+                             exclude_participant_labels, (), self.targets[TOP], self.targets[BOTTOM])
+
+    # The same filter, keeping only what applies to the given participants,
+    # e.g. so a build manifest only sees changes which affect their data.
+    def forParticipants(self, participants):
+        participants = set(map(participantKey, participants))
+        return ResultsFilter(None if self.participants is None else self.participants & participants,
+                             self.exclude_participants & participants, self.labels, self.exclude_labels,
+                             {p: w for p, w in self.exclude_participant_labels.items() if p in participants},
+                             self.exclude_where, self.targets[TOP], self.targets[BOTTOM])
+
+    def checkResolved(self):
+        if len(self.exclude_where) > 0:
+            print("ERROR: results filter has Qualtrics rules which have not been resolved", file=sys.stderr)
+            sys.exit(1)
+
+    def includesParticipant(self, participant):
+        participant = participantKey(participant)
+        return (self.participants is None or participant in self.participants)\
+               and not participant in self.exclude_participants
+
+    def includesLabel(self, participant, label):
+        if not self.includesParticipant(participant):
+            return False
+
+        if self.labels is not None and not any(isLike(label, w) for w in self.labels):
+            return False
+
+        excluded = self.exclude_labels + self.exclude_participant_labels.get(participantKey(participant), ())
+        return not any(isLike(label, w) for w in excluded)
+
+    # target IDs to include for the label (None for all)
+    def getTargets(self, label):
+        return self.targets[labelSide(label)]
+
+    def includesRow(self, participant, label, target_id):
+        targets = self.getTargets(label)
+        return self.includesLabel(participant, label) and (targets is None or target_id in targets)
+
+    # the rows of the results which pass the filter. Labels and subjects are
+    # given as their unique values plus an index into them for each row, so
+    # each value is only checked once.
+    def rowMask(self, labels, label_codes, subjects, subject_codes, target_ids):
+        self.checkResolved()
+
+        included = np.array([[self.includesLabel(subject, label) for label in labels] for subject in subjects],
+                            dtype=bool).reshape(len(subjects), len(labels))
+        keep = included[subject_codes, label_codes]
+
+        sides = np.array([labelSide(label) for label in labels], dtype=np.int64).reshape(-1)[label_codes]
+        for side, targets in self.targets.items():
+            if targets is not None:
+                keep &= (sides != side) | np.isin(target_ids, list(targets))
+
+        return keep
+
+    # the participants in a results tree (see ExperimentResults.resultsTree)
+    # which pass the filter, so excluded participants' files are never read
+    def filterTree(self, tree):
+        self.checkResolved()
+        return type(tree)((p, files) for p, files in tree.items() if self.includesParticipant(p))
+
+# EOF
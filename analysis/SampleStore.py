@@ -0,0 +1,187 @@
+# Compact storage for the valid gaze samples of an ExperimentResults. The
+# samples for each identifier (tracker/label pair) are kept as contiguous
+# arrays of target IDs, gaze positions and timestamps, ordered by subject, with
+# an offset index giving where each subject's samples start. This is 18 bytes
+# per sample, rather than 100+ for a (target_id, x, y) tuple in a list.
+
+from collections import OrderedDict
+from collections.abc import Mapping
+import numpy as np
+
+# gaze positions are whole or half pixels on screen, which float32 holds exactly
+GAZE_DTYPE = np.float32
+TARGET_DTYPE = np.int16
+TIMESTAMP_DTYPE = "datetime64[s]"
+
+# Convert "YYYY-MM-DD HH:MM:SS" timestamps. Anything which can't be parsed is
+# kept as NaT (not a time).
+def parseTimestamps(values):
+    uniques = list(dict.fromkeys(values))
+    lookup = {v: i for i, v in enumerate(uniques)}
+    codes = np.fromiter(map(lookup.__getitem__, values), dtype=np.int64, count=len(values))
+
+    parsed = np.full(len(uniques), np.datetime64("NaT"), dtype=TIMESTAMP_DTYPE)
+    for i, value in enumerate(uniques):
+        try:
+            parsed[i] = np.datetime64(value, "s")
+        except ValueError:
+            pass
+
+    return parsed[codes]
+
+# samples in the old subject_data format: a list of (target_id, x, y)
+def sampleTuples(target_ids, gaze_x, gaze_y):
+    return list(zip(target_ids.tolist(), gaze_x.astype(np.float64).tolist(),
+                    gaze_y.astype(np.float64).tolist()))
+
+# the samples for one identifier
+class IdentifierSamples:
+    # subjects gives the subject of each sample. The samples are stored grouped
+    # by subject (in order of first appearance), keeping their order within
+    # each subject.
+    def __init__(self, subjects, target_ids, gaze_x, gaze_y, timestamps):
+        subject_list = list(dict.fromkeys(subjects))
+        lookup = {s: i for i, s in enumerate(subject_list)}
+        subject_codes = np.fromiter(map(lookup.__getitem__, subjects), dtype=np.int64, count=len(subjects))
+
+        order = np.argsort(subject_codes, kind="stable")
+        counts = np.bincount(subject_codes, minlength=len(subject_list))
+        bounds = np.concatenate(([0], np.cumsum(counts)))
+
+        self.subjects = {s: (int(bounds[i]), int(bounds[i + 1])) for i, s in enumerate(subject_list)}
+        self.target_ids = np.asarray(target_ids)[order].astype(TARGET_DTYPE)
+        self.gaze_x = np.asarray(gaze_x)[order].astype(GAZE_DTYPE)
+        self.gaze_y = np.asarray(gaze_y)[order].astype(GAZE_DTYPE)
+        self.timestamps = parseTimestamps(np.asarray(timestamps)[order].tolist())
+
+    def __len__(self):
+        return len(self.target_ids)
+
+    def nbytes(self):
+        return self.target_ids.nbytes + self.gaze_x.nbytes + self.gaze_y.nbytes + self.timestamps.nbytes
+
+    # (target_ids, gaze_x, gaze_y) for one subject, or all of them if subject
+    # is None. These are views of the stored arrays, not copies.
+    def getSamples(self, subject=None):
+        start, end = (0, len(self)) if subject is None else self.subjects.get(subject, (0, 0))
+        return self.target_ids[start:end], self.gaze_x[start:end], self.gaze_y[start:end]
+
+    # the samples in the old subject_data format: a list of (target_id, x, y)
+    def getTuples(self, subject=None):
+        return sampleTuples(*self.getSamples(subject))
+
+class SampleStore:
+    def __init__(self):
+        self.identifiers = OrderedDict() # identifier -> IdentifierSamples
+        self.subject_idents = OrderedDict() # subject -> identifiers with samples for that subject
+
+    def addSubject(self, subject):
+        if not subject in self.subject_idents:
+            self.subject_idents[subject] = []
+
+    # identifiers should be added for each subject in the order they first
+    # appear in the data
+    def addSubjectIdentifier(self, subject, identifier):
+        self.addSubject(subject)
+        if not identifier in self.subject_idents[subject]:
+            self.subject_idents[subject].append(identifier)
+
+    def addIdentifier(self, identifier, subjects, target_ids, gaze_x, gaze_y, timestamps):
+        self.identifiers[identifier] = IdentifierSamples(subjects, target_ids, gaze_x, gaze_y, timestamps)
+
+    def getSamples(self, identifier, subject=None):
+        return self.identifiers[identifier].getSamples(subject)
+
+    def nbytes(self):
+        return sum(samples.nbytes() for samples in self.identifiers.values())
+
+    # A view of some of the subjects, sharing the stored samples. subject_idents
+    # is a list of (subject, identifier in the store, identifier in the view),
+    # in the order the identifiers should appear.
+    def select(self, subjects, subject_idents):
+        return SampleStoreView(self, subjects, subject_idents)
+
+# the samples for some of the subjects of an IdentifierSamples
+class IdentifierSamplesView:
+    def __init__(self, samples):
+        self.samples = samples
+        self.subjects = [] # in the order they are returned
+
+    def __len__(self):
+        return sum(end - start for start, end in (self.samples.subjects[s] for s in self.subjects))
+
+    # as IdentifierSamples.getSamples. The samples for a single subject are
+    # views of the stored arrays; all subjects are collected into new arrays.
+    def getSamples(self, subject=None):
+        subjects = self.subjects if subject is None else [s for s in self.subjects if s == subject]
+        parts = [self.samples.getSamples(s) for s in subjects]
+        if len(parts) == 0:
+            return tuple(column[0:0] for column in self.samples.getSamples())
+        elif len(parts) == 1:
+            return parts[0]
+
+        return tuple(np.concatenate(columns) for columns in zip(*parts))
+
+    def getTuples(self, subject=None):
+        return sampleTuples(*self.getSamples(subject))
+
+# Some of the subjects of a SampleStore, with their identifiers renamed (e.g.
+# to add a category to the labels). The samples aren't copied.
+class SampleStoreView:
+    def __init__(self, store, subjects, subject_idents):
+        self.store = store
+        self.identifiers = OrderedDict() # identifier -> IdentifierSamplesView
+        self.subject_idents = OrderedDict((subject, []) for subject in subjects)
+
+        for subject, store_ident, identifier in subject_idents:
+            if not identifier in self.identifiers:
+                self.identifiers[identifier] = IdentifierSamplesView(store.identifiers[store_ident])
+
+            if not subject in self.identifiers[identifier].subjects:
+                self.identifiers[identifier].subjects.append(subject)
+
+            if not identifier in self.subject_idents[subject]:
+                self.subject_idents[subject].append(identifier)
+
+    def getSamples(self, identifier, subject=None):
+        return self.identifiers[identifier].getSamples(subject)
+
+    # the samples belong to the store
+    def nbytes(self):
+        return 0
+
+# Read only view of a SampleStore in the old subject_data layout:
+# {subject: {identifier: [(target_id, x, y), ...]}}. The lists are only
+# created when they are looked up.
+class SubjectDataView(Mapping):
+    def __init__(self, store):
+        self.store = store
+
+    def __getitem__(self, subject):
+        if not subject in self.store.subject_idents:
+            raise KeyError(subject)
+        return SubjectSamplesView(self.store, subject)
+
+    def __iter__(self):
+        return iter(self.store.subject_idents)
+
+    def __len__(self):
+        return len(self.store.subject_idents)
+
+class SubjectSamplesView(Mapping):
+    def __init__(self, store, subject):
+        self.store = store
+        self.subject = subject
+
+    def __getitem__(self, identifier):
+        if not identifier in self.store.subject_idents[self.subject]:
+            raise KeyError(identifier)
+        return self.store.identifiers[identifier].getTuples(self.subject)
+
+    def __iter__(self):
+        return iter(self.store.subject_idents[self.subject])
+
+    def __len__(self):
+        return len(self.store.subject_idents[self.subject])
+
+# EOF
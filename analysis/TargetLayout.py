@@ -0,0 +1,65 @@
+# The screen positions of the targets for each label. Labels ending in
+# "bottom" use the bottom targets and all other labels use the top targets.
+# The layout is built once the results are loaded and isn't changed after
+# that, so lookups don't depend on (or change) any other state and can be
+# shared between threads.
+
+from types import MappingProxyType
+import numpy as np
+
+TOP = 0
+BOTTOM = 1
+
+def labelSide(label):
+    return BOTTOM if label.endswith("bottom") else TOP
+
+# The targets to include for each side, as (top, bottom) target IDs with None
+# for all of them (as from analyze_tracker_results.loadTargetSubset). Returns
+# a form which can be used as a key, or None if every target is included.
+def targetMask(targets):
+    if targets is None or all(ids is None for ids in targets):
+        return None
+
+    return tuple(None if ids is None else frozenset(ids) for ids in targets)
+
+def maskIncludes(mask, label, target_id):
+    return mask is None or mask[labelSide(label)] is None or target_id in mask[labelSide(label)]
+
+class TargetLayout:
+    # targets_top and targets_bottom map target ID -> (x, y). labels are the
+    # labels in the results, which are indexed up front.
+    def __init__(self, targets_top, targets_bottom, labels=()):
+        self.targets = (MappingProxyType(dict(targets_top)), MappingProxyType(dict(targets_bottom)))
+        self.num_targets = max([t + 1 for targets in self.targets for t in targets], default=0)
+
+        # target coords indexed by [side, target ID], NaN where there's no target
+        self.coords = np.full((2, self.num_targets, 2), np.nan)
+        for side_coords, targets in zip(self.coords, self.targets):
+            for target_id, coords in targets.items():
+                side_coords[target_id] = coords
+        self.coords.setflags(write=False)
+
+        self.label_sides = {label: labelSide(label) for label in labels}
+
+    def getSide(self, label):
+        side = self.label_sides.get(label)
+        return labelSide(label) if side is None else side
+
+    # read only target ID -> (x, y) for the label
+    def getTargets(self, label):
+        return self.targets[self.getSide(label)]
+
+    # the (x, y) coords of each target ID for the label, as a read only array
+    def getCoords(self, label):
+        return self.coords[self.getSide(label)]
+
+    # The coords of the target for each sample, given the label of each
+    # sample (as an index into labels). NaN for targets not in the layout.
+    def lookupCoords(self, labels, label_codes, target_ids):
+        sides = np.array([self.getSide(label) for label in labels] + [TOP], dtype=np.int64)[label_codes]
+        found = target_ids < self.num_targets
+        coords = np.full((len(target_ids), 2), np.nan)
+        coords[found] = self.coords[sides[found], target_ids[found]]
+        return coords
+
+# EOF
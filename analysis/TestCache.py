@@ -0,0 +1,128 @@
+# A cache of statistical test results, kept between runs so tests whose inputs
+# haven't changed (e.g. groups which don't include a newly added participant)
+# aren't run again. Each result is stored in its own file, named by a hash of
+# the test, its parameters, the library versions and the contents of its input
+# arrays, so a changed input never finds an old result. The least recently
+# used results are removed when the cache grows past TEST_CACHE_SIZE.
+#
+# Results are stored with pickle, so the cache directory must only be
+# writable by the user running the analysis.
+
+import hashlib
+import numpy as np
+import os
+import pickle
+import scikit_posthocs
+import scipy
+
+# bump this whenever the cached results change meaning
+TEST_CACHE_VERSION = 1
+
+USE_TEST_CACHE = True
+TEST_CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".test_cache")
+TEST_CACHE_SIZE = 64 * 1024 * 1024 # bytes
+
+RESULT_EXTENSION = ".pickle"
+
+# Add the contents of a test argument to the hash. Arguments are arrays (or
+# anything numpy can make an array of), or lists of them such as the groups
+# for a posthoc test.
+def hashArgument(h, value):
+    if isinstance(value, (list, tuple)) and len(value) > 0 and\
+       all(isinstance(v, (list, tuple, np.ndarray)) for v in value):
+        h.update(("list:" + str(len(value)) + ";").encode("utf-8"))
+        for v in value:
+            hashArgument(h, v)
+        return
+
+    values = np.ascontiguousarray(value)
+    h.update((values.dtype.str + str(values.shape) + ";").encode("utf-8"))
+    h.update(values.tobytes())
+
+def inputHash(test, args, kwargs):
+    h = hashlib.blake2b(digest_size=20)
+    h.update(repr((TEST_CACHE_VERSION, scipy.__version__, scikit_posthocs.__version__,
+                   test, len(args), sorted(kwargs.items()))).encode("utf-8"))
+    for value in args:
+        hashArgument(h, value)
+    return h.hexdigest()
+
+def resultPath(key):
+    return os.path.join(TEST_CACHE_DIR, key + RESULT_EXTENSION)
+
+# Returns (True, result) for a result in the cache, or (False, None). key is
+# from inputHash.
+def loadResult(key):
+    if not USE_TEST_CACHE:
+        return False, None
+
+    path = resultPath(key)
+    try:
+        with open(path, 'rb') as f:
+            result = pickle.load(f)
+        os.utime(path) # mark as recently used
+        return True, result
+    except (OSError, EOFError, pickle.UnpicklingError):
+        return False, None
+
+def saveResult(key, result):
+    if not USE_TEST_CACHE:
+        return
+
+    # write to a temporary file first so a half-written result is never
+    # picked up by another process
+    path = resultPath(key)
+    temp_path = path + ".tmp" + str(os.getpid())
+    try:
+        os.makedirs(TEST_CACHE_DIR, exist_ok=True)
+        with open(temp_path, 'wb') as f:
+            pickle.dump(result, f)
+        os.replace(temp_path, path)
+    except OSError as e:
+        print("WARN: could not write test cache: " + str(e))
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+# func(*args, **kwargs), or the result from the last time it was run with the
+# same inputs. test names the test, and must change if func does.
+def cachedTest(test, func, *args, **kwargs):
+    if not USE_TEST_CACHE:
+        return func(*args, **kwargs)
+
+    key = inputHash(test, args, kwargs)
+    found, result = loadResult(key)
+    if not found:
+        result = func(*args, **kwargs)
+        saveResult(key, result)
+
+    return result
+
+# Remove the least recently used results until the cache is no bigger than
+# TEST_CACHE_SIZE. This is run at the end of a batch of tests rather than for
+# each result.
+def trimTestCache():
+    try:
+        entries = [e for e in os.scandir(TEST_CACHE_DIR) if e.name.endswith(RESULT_EXTENSION)]
+    except OSError:
+        return
+
+    sizes = {}
+    for entry in entries:
+        try:
+            stat = entry.stat()
+        except OSError:
+            continue
+        sizes[entry.path] = (stat.st_mtime_ns, stat.st_size)
+
+    total = sum(size for _, size in sizes.values())
+    for path, (_, size) in sorted(sizes.items(), key=lambda item: item[1][0]):
+        if total <= TEST_CACHE_SIZE:
+            break
+
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        total -= size
+
+# EOF
@@ -0,0 +1,44 @@
+# Packed bitmasks (one bit per row, as returned by numpy.packbits) for marking
+# which eye readings are valid. Masks for the same rows line up bit for bit,
+# so they can be combined a byte (8 rows) at a time, and counted by looking up
+# the number of bits set in each byte.
+
+import numpy as np
+
+# number of bits set in each byte value
+POPCOUNT_TABLE = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+def packMask(mask):
+    return np.packbits(np.asarray(mask, dtype=bool))
+
+def unpackMask(packed, count):
+    return np.unpackbits(packed, count=count).astype(bool)
+
+# packbits pads the last byte with zeros. This clears those bits again after
+# an operation which may have set them (e.g. inverting the mask).
+def clearPadding(packed, count):
+    if count % 8 != 0 and len(packed) > 0:
+        packed[-1] &= np.uint8((0xFF << (8 - count % 8)) & 0xFF)
+    return packed
+
+def invertMask(packed, count):
+    return clearPadding(~packed, count)
+
+def popcount(packed):
+    return int(POPCOUNT_TABLE[packed].sum(dtype=np.int64))
+
+# masks is a list of (packed, count) pairs
+def concatMasks(masks):
+    if len(masks) == 0:
+        return packMask([])
+    return packMask(np.concatenate([unpackMask(packed, count) for packed, count in masks]))
+
+# The number of bits set for each group of rows. group_codes gives the group
+# of each row, or -1 to leave the row out.
+def groupedPopcount(packed, count, group_codes, num_groups):
+    group_codes = np.asarray(group_codes, dtype=np.int64)
+    included = group_codes >= 0
+    return np.bincount(group_codes[included], weights=unpackMask(packed, count)[included],
+                       minlength=num_groups).astype(np.int64)
+
+# EOF
@@ -21,6 +21,46 @@ TARGETS_ALL = range(36)
 def printUsage():
     print("Usage: " + sys.argv[0] + " <data_csv> [<(scatter|vector)=scatter> [<distance_cm=None> [<graph_output_png=None>] [<participant=None> [<subset_file=None>]]]]")
 
+# read a target subset file. Returns the [top, bottom] target lists.
+def loadTargetSubset(subset_file):
+    targets = [TARGETS_ALL, TARGETS_ALL]
+    with open(subset_file, 'r') as targfile:
+        reader = csv.reader(targfile)
+        for row in list(reader):
+            if row[0].lower() == "top":
+                targets[0] = list(int(i) for i in row[1:])
+            elif row[0].lower() == "bottom":
+                targets[1] = list(int(i) for i in row[1:])
+
+    return targets
+
+# plot the results and return the stats as CSV text. If graph_output_png is
+# None the plot is left open to be shown.
+def analyzeResults(ex_data, graph_type, distance_cm=None, graph_output_png=None, participant=None):
+    subject = None
+    if len(ex_data.subject_data) == 1:
+        subject = list(ex_data.subject_data.keys())[0]
+
+    ex_plot = ExperimentPlot(ex_data)
+
+    # if manually adding a legend, add the records here
+    legend_elements = None
+    if graph_type == SCATTER_PLOT:
+        ex_plot.plotScatter(subject)
+    elif graph_type == VECTOR_PLOT:
+        ex_plot.plotVector(subject, split=SPLIT_VECTOR_PLOTS, distance_cm=distance_cm, outname=graph_output_png)
+    else:
+        # this should never happen
+        print("ERROR: invalid graph type: " + graph_type)
+        printUsage()
+        sys.exit(1)
+
+    # add a polar grid over the top
+    # if distance_cm is not None:
+        # ex_plot.plotPolarGrid(distance_cm)
+
+    return ex_plot.plotStats(subject, distance_cm=distance_cm, participant=participant)
+
 if __name__ == '__main__':
     print("==========================================")
     print("  Data analysis for eye tracking results")
@@ -74,13 +114,7 @@ if __name__ == '__main__':
             sys.exit(1)
 
         # grab the targets out of the file
-        with open(subset_file, 'r') as targfile:
-            reader = csv.reader(targfile)
-            for row in list(reader):
-                if row[0].lower() == "top":
-                    targets[0] = list(int(i) for i in row[1:])
-                elif row[0].lower() == "bottom":
-                    targets[1] = list(int(i) for i in row[1:])
+        targets = loadTargetSubset(subset_file)
 
     # error checking
     if not os.path.exists(data_csv):
@@ -112,36 +146,14 @@ if __name__ == '__main__':
         print("ERROR: no subject data found", file=sys.stderr)
         sys.exit(1)
 
-    subject = None
-    if len(ex_data.subject_data) == 1:
-        subject = list(ex_data.subject_data.keys())[0]
-
-    print(str(len(ex_data.raw_data) - len(ex_data.invalid_rows)) + " data rows found")
+    print(str(ex_data.num_rows - len(ex_data.invalid_rows)) + " data rows found")
     print(str(len(ex_data.bad_data)) + " invalid rows found")
 
     ##########################
     ## Plotting starts here ##
     ##########################
 
-    ex_plot = ExperimentPlot(ex_data)
-
-    # if manually adding a legend, add the records here
-    legend_elements = None
-    if graph_type == SCATTER_PLOT:
-        ex_plot.plotScatter(subject)
-    elif graph_type == VECTOR_PLOT:
-        ex_plot.plotVector(subject, split=SPLIT_VECTOR_PLOTS, distance_cm=distance_cm, outname=graph_output_png)
-    else:
-        # this should never happen
-        print("ERROR: invalid graph type: " + graph_type)
-        printUsage()
-        sys.exit(1)
-
-    # add a polar grid over the top
-    # if distance_cm is not None:
-        # ex_plot.plotPolarGrid(distance_cm)
-
-    stats_raw = ex_plot.plotStats(subject, distance_cm=distance_cm, participant=participant)
+    stats_raw = analyzeResults(ex_data, graph_type, distance_cm, graph_output_png, participant)
 
     if graph_output_png is None:
         plt.show()
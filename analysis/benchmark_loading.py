@@ -0,0 +1,95 @@
+# Compare the row-by-row and columnar loaders in ExperimentResults. Both are
+# run over the same file, the results are checked for equality, and the
+# timings are printed. Given a results tree instead, the time to load it with
+# different numbers of worker processes is printed.
+
+import contextlib
+import io
+import os
+import sys
+import time
+
+import ExperimentResults as ER
+from ExperimentResults import ExperimentResults
+from analyze_tracker_results import PLOT_SIZE, TARGETS_ALL
+
+def printUsage():
+    print("Usage: " + sys.argv[0] + " <(data_csv|results_dir)> [<repeats=5>]")
+
+def timeLoad(data_csv, columnar, repeats):
+    best = None
+    ex_data = None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()): # loading is chatty
+            ex_data = ExperimentResults(data_csv, PLOT_SIZE,
+                                        targets_bottom=TARGETS_ALL,
+                                        targets_top=TARGETS_ALL,
+                                        columnar=columnar)
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+
+    return ex_data, best
+
+# time to parse a results tree (without the results cache) using each number
+# of workers
+def timeTreeLoad(results_dir, repeats):
+    ER.USE_RESULTS_CACHE = False
+    timings = {}
+    for workers in sorted(set([1, 2, 4, os.cpu_count()])):
+        best = None
+        for _ in range(repeats):
+            ER.PRELOADED_RESULTS.clear()
+            start = time.perf_counter()
+            with contextlib.redirect_stdout(io.StringIO()):
+                ER.loadResultsTree(results_dir, PLOT_SIZE, workers=workers)
+            elapsed = time.perf_counter() - start
+            if best is None or elapsed < best:
+                best = elapsed
+
+        timings[workers] = best
+
+    return timings
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        printUsage()
+        sys.exit(1)
+
+    data_csv = sys.argv[1]
+    if not os.path.exists(data_csv):
+        print("ERROR: data file does not exist: " + data_csv)
+        printUsage()
+        sys.exit(1)
+
+    repeats = 5
+    if len(sys.argv) > 2:
+        repeats = int(sys.argv[2])
+
+    if os.path.isdir(data_csv):
+        timings = timeTreeLoad(data_csv, repeats)
+        for workers, elapsed in timings.items():
+            print("{:2d} workers: {:.3f}s ({:.1f}x)".format(workers, elapsed, timings[1] / elapsed))
+        sys.exit(0)
+
+    row_data, row_time = timeLoad(data_csv, False, repeats)
+    col_data, col_time = timeLoad(data_csv, True, repeats)
+
+    matches = True
+    for attrib in ("subject_data", "bad_data", "target_bad_data", "ident_count",
+                   "ident_count_target", "targets_top", "targets_bottom",
+                   "invalid_rows", "num_rows"):
+        if getattr(row_data, attrib) != getattr(col_data, attrib):
+            print("ERROR: loaders disagree on " + attrib, file=sys.stderr)
+            matches = False
+
+    print("rows:     ", row_data.num_rows)
+    print("row-based: {:.3f}s".format(row_time))
+    print("columnar:  {:.3f}s".format(col_time))
+    print("speedup:   {:.1f}x".format(row_time / col_time))
+
+    if not matches:
+        sys.exit(1)
+
+# EOF
@@ -1,15 +1,20 @@
+from concurrent.futures import ProcessPoolExecutor
+import contextlib
+import io
 import matplotlib.cm as pltcm
 import matplotlib.colors as pltcolors
 import matplotlib.pyplot as plt
+import multiprocessing
 import numpy as np
 import os
 import pandas as pd
-from scikit_posthocs import posthoc_dunn
 from scipy import stats
-from statistics import pstdev, median
+from statistics import pstdev
 import sys
 
 from CollatedStats import CollatedStats
+from GroupTests import CONFIDENCE, DESCRIBE, DUNN, KRUSKAL, MANN_WHITNEY, SIGNIFICANCE, comparisonRows, runTests
+from TestCache import cachedTest, trimTestCache
 from ExperimentResults import INVALID_COORD, ALL_STUDIES
 
 # print full pandas DataTable instead of truncating
@@ -42,10 +47,14 @@ ACCURACY = 'Accuracy'
 PRECISION = 'Precision'
 SPECRX = 'Spectacle_Rx'
 
-# magic numbers for stat detail indices
-NUM_OBS_IDX = 0
-MEAN_IDX = 2
-VARIANCE_IDX = 3
+# test name for cached Spearman correlations (see TestCache)
+SPEARMAN = "spearmanr"
+
+# number of permutations/bootstrap resamples for the tests saved by
+# compareSamples (see GroupTests.runTests), 0 for none. These are slow, so
+# are only run when asked for, spread over the workers of createExtraGraphs.
+RESAMPLES = 0
+RESAMPLE_SEED = 0
 
 # create a scatterplot of spectacle Rx vs accuracy and precision
 def plotRxStats(allStats, project, addLegend=True):
@@ -98,8 +107,8 @@ def plotRxStats(allStats, project, addLegend=True):
             axs[i].set(xlabel="Spectacle strength in diopters (average spherical equivalent)",\
                        ylabel=l + " in degrees")
 
-        acc = stats.spearmanr(datasets[SPECRX], datasets[ACCURACY])
-        prec = stats.spearmanr(datasets[SPECRX], datasets[PRECISION])
+        acc = cachedTest(SPEARMAN, stats.spearmanr, datasets[SPECRX], datasets[ACCURACY])
+        prec = cachedTest(SPEARMAN, stats.spearmanr, datasets[SPECRX], datasets[PRECISION])
         df = len(datasets[SPECRX]) - 2
 
         print("  ====", label, "====")
@@ -124,60 +133,130 @@ def plotRxStats(allStats, project, addLegend=True):
 
     plt.close()
 
+# The tests are run by GroupTests.runTests, and these print them from the rows
+# of the test table for one comparison (see GroupTests.comparisonRows).
+
+def testRows(rows, test):
+    return [row for row in rows if row.test == test]
+
+# the DESCRIBE rows for a comparison, one for each group in order
+def groupRows(rows):
+    return testRows(rows, DESCRIBE)
+
+def describeText(row):
+    return "DescribeResult(nobs=" + repr(np.int64(row.n)) +\
+           ", minmax=" + repr((np.float64(row.min), np.float64(row.max))) +\
+           ", mean=" + repr(np.float64(row.mean)) +\
+           ", variance=" + repr(np.float64(row.variance)) +\
+           ", skewness=" + repr(np.float64(row.skewness)) +\
+           ", kurtosis=" + repr(np.float64(row.kurtosis)) + ")"
+
+def printMannWhitneyTest(rows, prefix=""):
+    for mannwhitney in testRows(rows, MANN_WHITNEY):
+        print(prefix, "MannwhitneyuResult(statistic=", repr(np.float64(mannwhitney.statistic)),\
+              ", pvalue=", repr(np.float64(mannwhitney.pvalue)), ")", sep="")
+        if mannwhitney.pvalue < SIGNIFICANCE:
+            print(prefix, "!!! SIGNIFICANT RESULT: SAMPLES ARE DIFFERENT !!!", sep="")
+        else:
+            print(prefix, "non-significant result: samples are not different", sep="")
+
+def printKruskalTest(rows, prefix=""):
+    groups = groupRows(rows)
+    for row in groups:
+        print(" ", row.group, "::", describeText(row))
+    print("")
+
+    for kruskal in testRows(rows, KRUSKAL):
+        print(prefix, "KruskalResult(statistic=", repr(np.float64(kruskal.statistic)),\
+              ", pvalue=", repr(np.float64(kruskal.pvalue)), ")", sep="")
+        if kruskal.pvalue < SIGNIFICANCE:
+            print(prefix, "!!! SIGNIFICANT RESULT: SAMPLES ARE DIFFERENT !!!", sep="")
+            print(prefix, "Posthoc Dunn test (Bonferroni):", sep="")
+            positions = pd.Index(np.arange(1, len(groups) + 1))
+            pvalues = np.array([row.pvalue for row in testRows(rows, DUNN)])
+            dunn = pd.DataFrame(pvalues.reshape(len(groups), len(groups)), index=positions, columns=positions)
+            print(dunn)
+            print("")
+        else:
+            print(prefix, "non-significant result: samples are not different", sep="")
+
+# print the confidence interval from a DESCRIBE row, returning (mean, sem)
+def printConfidenceInterval(row, confidence=CONFIDENCE, prefix=""):
+    ci = (np.float64(row.ci_low), np.float64(row.ci_high))
+    print(prefix, "SEM=", str(row.sem), " ", int(confidence * 100), "% CI: ", str(ci), sep="")
+    return (np.float64(row.mean), np.float64(row.sem))
+
+def printConfidenceIntervals(rows, confidence=CONFIDENCE, prefix=""):
+    for n, row in enumerate(groupRows(rows)):
+        pre = str(prefix) + str(n+1) + " :: " + str(row.group) + ": "
+        printConfidenceInterval(row, confidence, pre)
+
+# run and print a single test. The datasets can be a dict of name -> values
+# or a list of values (named by their position).
+def runTest(groups, test, confidence=CONFIDENCE):
+    return comparisonRows(runTests([({}, groups, test)], confidence=confidence))[0]
+
 def mannWhitneyTest(datasets, prefix=""):
-    mannwhitney = stats.mannwhitneyu(*datasets)
-    print(prefix, mannwhitney, sep="")
-    if mannwhitney.pvalue < 0.05:
-        print(prefix, "!!! SIGNIFICANT RESULT: SAMPLES ARE DIFFERENT !!!", sep="")
-    else:
-        print(prefix, "non-significant result: samples are not different", sep="")
+    printMannWhitneyTest(runTest(dict(enumerate(datasets)), MANN_WHITNEY), prefix)
 
 def kruskalTest(dataset_dict, prefix=""):
-    # make sure the keys and values are ordered correctly
-    vals = []
-    keys = []
-
-    for k,v in dataset_dict.items():
-        keys.append(k)
-        vals.append(v)
-        print(" ", k, "::", stats.describe(v))
-    print("")
+    if not isinstance(dataset_dict, dict):
+        dataset_dict = dict(enumerate(dataset_dict))
+    printKruskalTest(runTest(dataset_dict, KRUSKAL), prefix)
+
+def confidenceInterval(dataset, confidence=CONFIDENCE, prefix=""):
+    return printConfidenceInterval(groupRows(runTest({None: dataset}, DESCRIBE, confidence))[0], confidence, prefix)
+
+def confidenceIntervals(datasets, confidence=CONFIDENCE, prefix=""):
+    printConfidenceIntervals(runTest(datasets, DESCRIBE, confidence), confidence, prefix)
+
+# The samples compared by compareSamples, worked out once for all of the
+# attributes: for each participant, a list of (participant record, label ->
+# sample data). The sample data for a label has the accuracy of each raw
+# reading and the precision of each target (in degrees, in target order),
+# and the bad read counts from the 'all' targets record.
+def sampleCube(allStats):
+    cube = []
+    for (p, d) in allStats.participantData.items():
+        labels = {}
+        for targ in d.targetStats:
+            if not targ.label in labels:
+                labels[targ.label] = {ACCURACY: [], PRECISION: [], 'badReads': [0, 0, 0, 0]}
+            samples = labels[targ.label]
 
-    kruskal = stats.kruskal(*vals)
-    print(prefix, kruskal, sep="")
-    if kruskal.pvalue < 0.05:
-        print(prefix, "!!! SIGNIFICANT RESULT: SAMPLES ARE DIFFERENT !!!", sep="")
-        print(prefix, "Posthoc Dunn test (Bonferroni):", sep="")
-        dunn = posthoc_dunn(vals, p_adjust='bonferroni')
-        for a in (0,1):
-            dunn.set_axis(keys, axis=a)
-        print(dunn)
-        print("")
-    else:
-        print(prefix, "non-significant result: samples are not different", sep="")
-
-def confidenceInterval(dataset, confidence=0.95, prefix=""):
-    mean = np.mean(dataset)
-    sem = stats.sem(dataset)
-    ci = stats.t.interval(confidence, len(dataset)-1, loc=mean, scale=sem)
-    print(prefix, "SEM=", str(sem), " ", int(confidence * 100), "% CI: ", str(ci), sep="")
-    return (np.mean(dataset), sem)
-
-def confidenceIntervals(datasets, confidence=0.95, prefix=""):
-    for n, (lab, dat) in enumerate(datasets.items()):
-        pre = str(prefix) + str(n+1) + " :: " + str(lab) + ": "
-        confidenceInterval(dat, confidence, pre)
-
-def compareSamples(allStats, project, attrib=None, plotTitle="A Nice Plot Title", addLegend=True):
+            if targ.targetID == "all":
+                samples['badReads'][0] += targ.recordN
+                samples['badReads'][1] += targ.badReadRight + targ.badReadLeft
+                samples['badReads'][2] += targ.badReadBoth
+                samples['badReads'][3] +=\
+                    (targ.recordN - targ.badReadLeft - targ.badReadRight - targ.badReadBoth)
+
+            targRawVals = [v * d.PxToDegConvFactor for v in targ.rawDistanceValuesPx\
+                           if v != INVALID_COORD] # paranoia - this shouldn't happen
+            samples[ACCURACY] += targRawVals
+
+            if len(targRawVals) > 0:
+                samples[PRECISION].append(pstdev(targRawVals))
+
+        cube.append((d, labels))
+
+    return cube
+
+# cube is from sampleCube, so it can be shared by the comparisons for each
+# attribute. workers is the number of processes for the resampling.
+def compareSamples(allStats, project, attrib=None, plotTitle="A Nice Plot Title", addLegend=True, cube=None, workers=1):
     # compare positions for the given attribute values, or all if None
     datasets = {}
 
     print(" == Comparing sets within the same tracker setup:", plotTitle, "==")
 
+    if cube is None:
+        cube = sampleCube(allStats)
+
     counts = {}
 
     badReads = {}
-    for (p, d) in allStats.participantData.items():
+    for (d, labels) in cube:
         category = "all"
         if attrib != None:
             category = getattr(d, attrib)
@@ -189,64 +268,71 @@ def compareSamples(allStats, project, attrib=None, plotTitle="A Nice Plot Title"
         if category not in datasets:
             datasets[category] = {ACCURACY: {}, PRECISION: {}}
 
-        for targ in d.targetStats:
+        if len(labels) > 0 and not category in badReads:
+            badReads[category] = {}
+
+        for label, samples in labels.items():
             for stat in (ACCURACY, PRECISION):
-                if targ.label not in datasets[category][stat]:
-                    datasets[category][stat][targ.label] = []
+                if label not in datasets[category][stat]:
+                    datasets[category][stat][label] = []
+                datasets[category][stat][label] += samples[stat]
 
-            if not category in badReads:
-                badReads[category] = {}
+            if not label in badReads[category]:
+                badReads[category][label] = {'n': 0, 'one': 0, 'both': 0, 'none': 0}
 
-            if not targ.label in badReads[category]:
-                badReads[category][targ.label] = {'n': 0, 'one': 0, 'both': 0, 'none': 0}
+            for key, count in zip(('n', 'one', 'both', 'none'), samples['badReads']):
+                badReads[category][label][key] += count
 
-            if targ.targetID == "all":
-                badReads[category][targ.label]['n'] += targ.recordN
-                badReads[category][targ.label]['one'] += targ.badReadRight + targ.badReadLeft
-                badReads[category][targ.label]['both'] += targ.badReadBoth
-                badReads[category][targ.label]['none'] +=\
-                    (targ.recordN - targ.badReadLeft - targ.badReadRight - targ.badReadBoth)
+    # Everything is tested in one go (see GroupTests.runTests) and then the
+    # results are printed. Comparing the positions in each category, the
+    # categories at each position, and bad reads by position and category.
+    comparisons = []
+    tables = []
 
-            targRawVals = []
-            for v in targ.rawDistanceValuesPx:
-                if v != INVALID_COORD: # paranoia - this shouldn't happen
-                    targRaw = v * d.PxToDegConvFactor
-                    datasets[category][ACCURACY][targ.label].append(targRaw)
-                    targRawVals.append(targRaw)
+    byposition = {} # (category, stat) -> comparison index
+    bylabel = {ACCURACY: {}, PRECISION: {}} # compare sets with the same label (e.g. all in top position)
+    for category, labelstats in datasets.items():
+        for stat, labels in labelstats.items():
+            if len(labels) == 0:
+                continue
 
-            if len(targRawVals) > 0:
-                datasets[category][PRECISION][targ.label].append(pstdev(targRawVals))
+            byposition[(category, stat)] = len(comparisons)
+            comparisons.append(({"attrib": attrib, "comparing": "label", "category": category, "stat": stat}, labels))
 
-    print(" === category counts ===")
-    print(counts)
-    print("")
+            for label, vals in labels.items():
+                if len(vals) == 0:
+                    continue
+                if label not in bylabel[stat]:
+                    bylabel[stat][label] = {}
+                bylabel[stat][label][category] = vals
 
-    print(" === chi-square of bad reads (per position) ===")
+    bycategory = {} # (stat, label) -> comparison index
+    if len(datasets) > 1: # this means we have more than one category
+        for stat, labels in bylabel.items():
+            for label, cats in labels.items():
+                bycategory[(stat, label)] = len(comparisons)
+                comparisons.append(({"attrib": attrib, "comparing": "category", "stat": stat, "label": label}, cats))
 
     # HACK: compare different trackers in the same position (validation study)
     trackersPerPos = {}
 
     catVals = {}
     EYE_CATS = ["one eye", "both eyes", "none"]
+    badReadTables = [] # (category, vals, items, table index, [(position, tracker data, table index)])
     for cat, vals in badReads.items():
-        print("  ", cat, sep="")
-
         items = list(list(v.values()) for v in vals.values())
         assert(len(items) >= 2) # sanity check
         catVals[cat] = items[0]
 
         if len(items) < 2:
-            print("    Ignoring category as insufficient data")
+            badReadTables.append((cat, vals, items, None, []))
             continue
 
         # collate the values by category
         for i in range(1, len(items)):
             catVals[cat] = [x + y for x, y in zip(items[i], catVals[cat])]
 
-        print("    " + str(['n'] + EYE_CATS))
         for i, (k,v) in enumerate(vals.items()):
-            print("    ", k, v, sep="")
-
             # trackers per position (hack)
             sp = k.split(" :: ")
             if len(sp) == 2:
@@ -255,90 +341,120 @@ def compareSamples(allStats, project, attrib=None, plotTitle="A Nice Plot Title"
 
                 trackersPerPos[sp[1]][sp[0]] = items[i]
 
-        #chi = stats.chisquare(items[0][1:], items[1][1:], axis=None)
-        chi = stats.chisquare([i[1:] for  i in items])
+        tables.append(({"attrib": attrib, "comparing": "label", "category": cat},
+                       dict((k, item[1:]) for k, item in zip(vals, items)), EYE_CATS))
+        tableIndex = len(tables) - 1
+
+        # now compare each distance
+        positions = []
+        for pos, posData in trackersPerPos.items():
+            tables.append(({"attrib": attrib, "comparing": "tracker", "category": cat, "position": pos},
+                           dict((tracker, chiData[1:]) for tracker, chiData in posData.items()), EYE_CATS))
+            positions.append((pos, dict(posData), len(tables) - 1))
+
+        badReadTables.append((cat, vals, items, tableIndex, positions))
+
+    # compare categories irrespective of position
+    allCatsTable = None
+    if len(catVals) >= 2:
+        tables.append(({"attrib": attrib, "comparing": "category"},
+                       dict((cat, vals[1:]) for cat, vals in catVals.items()), EYE_CATS))
+        allCatsTable = len(tables) - 1
+
+    testTable = runTests(comparisons, tables, resamples=RESAMPLES, seed=RESAMPLE_SEED, workers=workers)
+    tests = comparisonRows(testTable)
+    def chiRows(tableIndex):
+        return tests[len(comparisons) + tableIndex]
+
+    # also save the test results
+    testTable.to_csv(os.path.join(project, "all", "plots", project + "_" + str(attrib) + "_tests.csv"), index=False)
+
+    print(" === category counts ===")
+    print(counts)
+    print("")
+
+    print(" === chi-square of bad reads (per position) ===")
+
+    for cat, vals, items, tableIndex, positions in badReadTables:
+        print("  ", cat, sep="")
+
+        if tableIndex is None:
+            print("    Ignoring category as insufficient data")
+            continue
+
+        print("    " + str(['n'] + EYE_CATS))
+        for k, v in vals.items():
+            print("    ", k, v, sep="")
 
-        for i, c in enumerate(EYE_CATS):
-            if chi.pvalue[i] < 0.05:
+        chi = chiRows(tableIndex)
+        for c, row in zip(EYE_CATS, chi):
+            if row.pvalue < SIGNIFICANCE:
                 print("    !!! bad reads (" + c + ") are statistically different !!!")
 
         print("    n = ", items[0][0], ", m = ", items[1][0], sep="")
-        print("    chi = ", chi[0], sep="")
-        print("    p = ", chi[1], sep="")
+        print("    chi = ", np.array([row.statistic for row in chi]), sep="")
+        print("    p = ", np.array([row.pvalue for row in chi]), sep="")
 
-        # now compare each distance
-        for pos, posData in trackersPerPos.items():
-            chitable = []
+        for pos, posData, posTable in positions:
+            chitable = list(posData.values())
             print()
             print(" ", pos)
-            for tracker, chiData in posData.items():
+            for tracker in posData:
                 print("  ", tracker)
-                chitable.append(chiData)
-
-            chi = stats.chisquare([i[1:] for i in chitable])
 
-            for i, c in enumerate(EYE_CATS):
-                if chi.pvalue[i] < 0.05:
+            for c, row in zip(EYE_CATS, chiRows(posTable)):
+                if row.pvalue < SIGNIFICANCE:
                     print("    !!! bad reads (" + c + ") are statistically different !!!")
                     print("    n = ", chitable[0][0], ", m = ", chitable[1][0], sep="")
-                    print("    chi = ", chi[0][i], sep="")
-                    print("    p = ", chi[1][i], sep="")
+                    print("    chi = ", row.statistic, sep="")
+                    print("    p = ", row.pvalue, sep="")
                     print("")
 
     print("")
 
-    # compare categories irrespective of position
-    if len(catVals) >= 2:
+    if allCatsTable is not None:
         print("  All")
         print("    " + str(['n'] + EYE_CATS))
-        chitable = []
         for cat, vals in catVals.items():
             print("    " + str([cat] + vals))
-            chitable.append(vals[1:])
 
-        chi = stats.chisquare(chitable)
-        for i, c in enumerate(EYE_CATS):
-            if chi.pvalue[i] < 0.05:
+        chi = chiRows(allCatsTable)
+        for c, row in zip(EYE_CATS, chi):
+            if row.pvalue < SIGNIFICANCE:
                 print("    !!! bad reads (" + c + ") are statistically different !!!")
 
-        print("    chi = ", chi[0], sep="")
-        print("    p = ", chi[1], sep="")
+        print("    chi = ", np.array([row.statistic for row in chi]), sep="")
+        print("    p = ", np.array([row.pvalue for row in chi]), sep="")
 
     print("")
 
-    bylabel = {ACCURACY: {}, PRECISION: {}} # compare sets with the same label (e.g. all in top position)
     for category, labelstats in datasets.items():
         print(" ===", category, "(per position) ===")
         for stat, labels in labelstats.items():
             print(" === Comparing", stat, "(per position) ===")
-            for label, vals in labels.items():
-                if len(vals) == 0:
-                    continue
-                if label not in bylabel[stat]:
-                    bylabel[stat][label] = {}
-                if category not in bylabel[stat][label]:
-                    bylabel[stat][label][category] = []
-                bylabel[stat][label][category] += vals
-                stat_details = stats.describe(vals)
-
-                print("    ", label, " :: n=", stat_details[NUM_OBS_IDX],\
-                      ", mean=", stat_details[MEAN_IDX],\
-                      ", median=", median(vals),\
-                      ", variance=", stat_details[VARIANCE_IDX], sep="")
-                confidenceInterval(vals, prefix="      Confidence: ")
-
             if len(labels) == 0:
                 continue
 
+            rows = tests[byposition[(category, stat)]]
+            for row in groupRows(rows):
+                if row.n == 0:
+                    continue
+
+                print("    ", row.group, " :: n=", int(row.n),\
+                      ", mean=", row.mean,\
+                      ", median=", row.median,\
+                      ", variance=", row.variance, sep="")
+                printConfidenceInterval(row, prefix="      Confidence: ")
+
             print("")
             if len(labels.values()) < 2:
                 print("  << no stats can be done as two groups needed, only have one >>")
             elif len(labels.values()) == 2:
-                mannWhitneyTest(labels.values(), prefix="    ")
+                printMannWhitneyTest(rows, prefix="    ")
             else:
-                kruskalTest(labels, prefix="    ")
+                printKruskalTest(rows, prefix="    ")
                 print("    Confidences:")
-                confidenceIntervals(labels, prefix="      ")
+                printConfidenceIntervals(rows, prefix="      ")
             
             print("")
 
@@ -361,32 +477,32 @@ def compareSamples(allStats, project, attrib=None, plotTitle="A Nice Plot Title"
                 if not label in errorbardata:
                     errorbardata[label] = {ACCURACY: [[],[],[]], PRECISION: [[],[],[]]} # x, y, error
 
-                for index, (cat, vals) in enumerate(cats.items()):
+                rows = tests[bycategory[(stat, label)]]
+                for index, ((cat, vals), row) in enumerate(zip(cats.items(), groupRows(rows))):
                     if cat is None:
                         continue
 
                     errorbaroutdata.append([label, stat, cat, ",".join(str(v) for v in vals)])
 
-                    stat_details = stats.describe(vals)
                     print("  ", (index + 1), " (", cat, ") ::",\
-                          " n=", stat_details[NUM_OBS_IDX],\
-                          ", mean=", stat_details[MEAN_IDX],\
-                          ", median=", median(vals),\
-                          ", variance=", stat_details[VARIANCE_IDX],\
-                          ", SD=", pstdev(vals),\
-                          ", skew=", stats.skew(vals), sep="")
-                    ci = confidenceInterval(vals, prefix="    Confidence: ")
+                          " n=", int(row.n),\
+                          ", mean=", row.mean,\
+                          ", median=", row.median,\
+                          ", variance=", row.variance,\
+                          ", SD=", row.sd,\
+                          ", skew=", row.skewness, sep="")
+                    ci = printConfidenceInterval(row, prefix="    Confidence: ")
                     errorbardata[label][stat][0].append(cat)
                     errorbardata[label][stat][1].append(ci[0])
                     errorbardata[label][stat][2].append(ci[1])
 
                 print("")
                 if len(cats.values()) == 2:
-                    mannWhitneyTest(cats.values(), prefix="    ")
+                    printMannWhitneyTest(rows, prefix="    ")
                 else:
-                    kruskalTest(cats, prefix="    ")
+                    printKruskalTest(rows, prefix="    ")
                 print("    Confidences:")
-                confidenceIntervals(cats, prefix="      ")
+                printConfidenceIntervals(rows, prefix="      ")
                 print("")
                 print("#############################")
                 print("")
@@ -419,7 +535,7 @@ def compareSamples(allStats, project, attrib=None, plotTitle="A Nice Plot Title"
                     axs[index].plot(x, m*x + b, color=col)
 
                     print("    y=mx+b, m=", m, ", b=", b, sep="")
-                    print("    ", stats.spearmanr(dat[0], dat[1]), " (df=", len(dat[0])-2, ")", sep="")
+                    print("    ", cachedTest(SPEARMAN, stats.spearmanr, dat[0], dat[1]), " (df=", len(dat[0])-2, ")", sep="")
 
                 index += 1
 
@@ -510,10 +626,60 @@ def plotValidationErrors(allStats, project):
 
     plt.close()
 
+# run one of the extra graphs in a worker, returning what it printed
+def runGraphTask(func, args):
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+        func(*args)
+        plt.close('all')
+
+    return output.getvalue()
+
+# all of the extra graphs and stats. allStats can be loaded from the stats
+# and raw CSV files, or straight from ExperimentResults objects (see
+# CollatedStats) to skip parsing the data again. The graphs are independent,
+# so with more than one worker they are run at the same time; what they print
+# is collected and printed in the same order as running them one by one. With
+# RESAMPLES, the resampling takes far longer than the rest, so instead the
+# graphs are run one by one and the resampling is spread over the workers.
+def createExtraGraphs(allStats, project, workers=1):
+    cube = sampleCube(allStats)
+    resampleWorkers = workers if RESAMPLES > 0 else 1
+    tasks = [
+        (plotRxStats, (allStats, project)),
+        (compareSamples, (allStats, project, None, "Eye tracker performance - all data", True, cube, resampleWorkers)),
+        # (compareSamples, (allStats, project, 'eyeColour', "Eye tracker performance in relation to eye colour", True, cube, resampleWorkers)),
+        # (compareSamples, (allStats, project, 'eyesBlue', "Eye tracker performance in relation to eye blueness", True, cube, resampleWorkers)),
+        (compareSamples, (allStats, project, 'eyesDark', "Eye tracker performance in relation to eye darkness", True, cube, resampleWorkers)),
+        (compareSamples, (allStats, project, 'correction', "Eye tracker performance in relation to vision correction", True, cube, resampleWorkers)),
+        (compareSamples, (allStats, project, 'panto', "Eye tracker performance in relation to pantoscopic tilt", True, cube, resampleWorkers)),
+        (compareSamples, (allStats, project, 'posture33cm', "Eye tracker performance in relation to near vergence", True, cube, resampleWorkers)),
+        (compareSamples, (allStats, project, 'posture3m', "Eye tracker performance in relation to distance vergence", True, cube, resampleWorkers))
+    ]
+    # plotValidationErrors(allStats, project)
+
+    if workers <= 1 or RESAMPLES > 0:
+        for func, args in tasks:
+            func(*args)
+            plt.close('all')
+        trimTestCache()
+        return
+
+    context = None
+    if "fork" in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context("fork")
+
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context) as pool:
+        futures = [pool.submit(runGraphTask, func, args) for func, args in tasks]
+        for future in futures:
+            sys.stdout.write(future.result())
+
+    trimTestCache()
+
 if __name__ == '__main__':
     def printUsage():
         print("Usage: " + sys.argv[0] + " <qualtrics_csv> <participant_stats_csv> <raw_csv> <project> " +
-              "[<study=" + ALL_STUDIES[1] + ">]")
+              "[<study=" + ALL_STUDIES[1] + "> [<workers=1>]]")
 
     if len(sys.argv) < 5:
         printUsage()
@@ -525,6 +691,10 @@ if __name__ == '__main__':
     project = sys.argv[4]
     study = sys.argv[5]
 
+    workers = 1
+    if len(sys.argv) > 6:
+        workers = int(sys.argv[6])
+
     argsValid = True
     for f in (qualtrics_csv, participant_stats_csv, raw_csv):
         if not os.path.exists(f):
@@ -541,16 +711,6 @@ if __name__ == '__main__':
     # load all of the data from the two files into one usable object
     allStats = CollatedStats(qualtrics_csv, participant_stats_csv, raw_csv, study)
 
-    plotRxStats(allStats, project)
-    plt.close('all')
-    compareSamples(allStats, project, None, "Eye tracker performance - all data")
-    # compareSamples(allStats, project, 'eyeColour', "Eye tracker performance in relation to eye colour")
-    # compareSamples(allStats, project, 'eyesBlue', "Eye tracker performance in relation to eye blueness")
-    compareSamples(allStats, project, 'eyesDark', "Eye tracker performance in relation to eye darkness")
-    compareSamples(allStats, project, 'correction', "Eye tracker performance in relation to vision correction")
-    compareSamples(allStats, project, 'panto', "Eye tracker performance in relation to pantoscopic tilt")
-    compareSamples(allStats, project, 'posture33cm', "Eye tracker performance in relation to near vergence")
-    compareSamples(allStats, project, 'posture3m', "Eye tracker performance in relation to distance vergence")
-    # plotValidationErrors(allStats, project)
+    createExtraGraphs(allStats, project, workers)
 
 # EOF
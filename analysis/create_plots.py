@@ -0,0 +1,533 @@
+# Python version of create_plots.ps1. All of the stats and plots for a project
+# are created in one process: per participant stats, the category splits, the
+# composite plots, the extra graphs and (for the position study) the stats for
+# the ideal target locations. Each results file is loaded once and shared by
+# every dataset collated from it, and independent stages are run on a pool of
+# worker processes. An incremental build only rebuilds the outputs whose inputs
+# have changed since the last build.
+
+import contextlib
+from concurrent.futures import ProcessPoolExecutor
+import csv
+import io
+import matplotlib
+matplotlib.use("Agg") # plots are only written to file
+import matplotlib.pyplot as plt
+import multiprocessing
+import os
+import shutil
+import subprocess
+import sys
+import traceback
+
+from analyze_tracker_results import PLOT_SIZE, TARGETS_ALL, analyzeResults, loadTargetSubset
+from BuildManifest import BuildManifest
+from CollatedStats import CollatedStats
+from create_extra_graphs import createExtraGraphs
+from create_target_stats import createTargetStats
+from ExperimentPlot import VECTOR_PLOT, ExperimentPlot
+from ExperimentResults import ALL_STUDIES, ExperimentResults, PRELOADED_RESULTS, preloadResults, resultsTree
+from ResultsFilter import ResultsFilter, qualtricsGroups
+
+PLOTS = [VECTOR_PLOT] # can also have 'scatter' here too
+
+SPEC_TYPES = {
+    'mf': "*multifocal*",
+    'sv': "*single vision*",
+    'bf': "*bifocal*",
+    'none': "None",
+    'cl': "*Contact lenses*"
+}
+
+# XXX not being used at the moment
+COLOURS = {
+    'dark_brown': "Dark Brown",
+    'brown': "Brown",
+    'hazel': "Hazel",
+    'blue': "Blue",
+    'green': "Green"
+}
+
+# a bit of a hack to get blue vs. non-blue categories
+BLUENESS = {
+    'blue': "Blue",
+    'non-blue': "?[ar]*"
+}
+
+DARKNESS = {
+    'light': "*e*",
+    'dark': "*Brown"
+}
+
+# Qualtrics column -> {abbreviation: wildcard}. Wildcards are matched without
+# regard to case, as PowerShell's -like does.
+CATEGORIES = {
+    'Correction': SPEC_TYPES,
+    # 'EyeColour': BLUENESS,
+    'EyeColour': DARKNESS
+}
+
+DISTANCE_CM = {
+    "position": 65,
+    "validation": 80
+}
+
+# position study: data for a screen position is excluded if there were more
+# validation errors than this
+MAX_VALIDATION_ERRORS = 3
+
+# Data left out of the analysis, as Qualtrics rules (see ResultsFilter).
+# Contact lens wearers are excluded as there are too few of them.
+EXCLUSION_RULES = [("Correction", "like", "*contact lens*", "*")]
+POSITION_EXCLUSION_RULES = [("ValidationErrorsTop", ">", MAX_VALIDATION_ERRORS, "*top"),
+                            ("ValidationErrorsBottom", ">", MAX_VALIDATION_ERRORS, "*bottom")]
+
+RUN_IDEAL_STATS = True
+IDEAL_CORRECTIONS = ("none", "sv", "mf")
+
+# Set this to only write the stats for the ideal targets, without the plots
+# and extra graphs. The stats are then worked out from the results already
+# loaded for all targets, by only counting the ideal targets (see
+# ExperimentResults.getStats), rather than loading the results again.
+IDEAL_STATS_ONLY = False
+
+# Note: this is required to create additional plots also
+CREATE_INDIVIDUAL_CAT_PLOTS = True
+
+# An incremental build keeps the previous outputs, and only rebuilds those
+# whose inputs have changed (see BuildManifest). A full build starts again.
+INCREMENTAL_BUILD = "incremental"
+FULL_BUILD = "full"
+BUILD_MODES = (INCREMENTAL_BUILD, FULL_BUILD)
+
+# kept in each output directory
+MANIFEST_FILE = "manifest.json"
+
+# The results being processed by doStats, loaded once. Each stage works on a
+# view of these (see ExperimentResults.select) rather than loading its own
+# copy, and forked workers share them with the main process. They are kept
+# for the next doStats if it needs the same results.
+SHARED_RESULTS = {}
+
+def printUsage():
+    print("Usage: " + sys.argv[0] + " <project> <data_dir> <qualtrics_csv> [<output_dir=project> [<workers=" +\
+          str(os.cpu_count()) + "> [<(" + "|".join(BUILD_MODES) + ")=" + FULL_BUILD + ">]]]")
+
+def loadQualtrics(qualtrics_csv):
+    records = {}
+    with open(qualtrics_csv, 'r') as csvfile:
+        for row in csv.DictReader(csvfile):
+            records[int(row['ID'])] = row
+
+    return records
+
+# Run the stages (output, participants, function, arguments) built by
+# doStats. Forked workers share the results loaded by the main process, so
+# the stages are run in this process when workers can't be forked. A stage
+# which fails doesn't stop the others; the outputs of the failed stages are
+# returned.
+def runStages(stages, workers):
+    # the worker count doesn't change the extra graphs, so it isn't one of the
+    # stage's arguments (which are recorded in the manifest)
+    def kwargs(func):
+        return {"workers": workers} if func == runExtraGraphs else {}
+
+    failed = []
+    def stageFailed(output, e):
+        print("ERROR: could not create " + output + ":\n" +\
+              "".join(traceback.format_exception(e)), file=sys.stderr)
+        failed.append(output)
+
+    if workers <= 1 or "fork" not in multiprocessing.get_all_start_methods():
+        for output, _, func, args in stages:
+            try:
+                func(*args, **kwargs(func))
+            except Exception as e:
+                stageFailed(output, e)
+                plt.close('all')
+        return failed
+
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("fork")) as pool:
+        futures = [(output, pool.submit(func, *args, **kwargs(func))) for output, _, func, args in stages]
+        for output, future in futures:
+            try:
+                future.result()
+            except Exception as e:
+                stageFailed(output, e)
+    return failed
+
+# load the results for the participants (in order) to be shared by the stages
+def loadSharedResults(data_csvs, results_filter, workers):
+    key = (tuple(data_csvs), results_filter)
+    if SHARED_RESULTS.get("key") == key:
+        return
+
+    SHARED_RESULTS.clear()
+    preloadResults(data_csvs, workers)
+    with contextlib.redirect_stdout(io.StringIO()):
+        SHARED_RESULTS["results"] = ExperimentResults(data_csvs, PLOT_SIZE, results_filter=results_filter)
+    SHARED_RESULTS["key"] = key
+    PRELOADED_RESULTS.clear()
+
+# The equivalent of running analyze_tracker_results.py on the participants'
+# collated files (see ExperimentResults.select for label_prefix). Returns the
+# stats text, or None if there was no data.
+def runAnalysis(subjects, label_prefix, graph_type, distance_cm, graph_output_png, participant):
+    with contextlib.redirect_stdout(io.StringIO()): # loading and plotting are chatty
+        ex_data = SHARED_RESULTS["results"].select(subjects, label_prefix)
+
+        if len(ex_data.subject_data) == 0:
+            print("ERROR: no subject data found for " + graph_output_png, file=sys.stderr)
+            return None
+
+        stats_raw = analyzeResults(ex_data, graph_type, distance_cm, graph_output_png, participant)
+
+    with open(graph_output_png + ".stats.csv", 'w+') as f:
+        f.write(stats_raw)
+
+    plt.close('all')
+    return stats_raw
+
+# As runAnalysis, but only the stats are written (to stats_csv), counting
+# just the given (top, bottom) targets.
+def runStats(subjects, label_prefix, distance_cm, stats_csv, participant, targets):
+    with contextlib.redirect_stdout(io.StringIO()):
+        ex_data = SHARED_RESULTS["results"].select(subjects, label_prefix)
+
+        if len(ex_data.subject_data) == 0:
+            print("ERROR: no subject data found for " + stats_csv, file=sys.stderr)
+            return None
+
+        subject = None
+        if len(ex_data.subject_data) == 1:
+            subject = list(ex_data.subject_data.keys())[0]
+
+        stats_raw = ExperimentPlot(ex_data).plotStats(subject, distance_cm=distance_cm, participant=participant,
+                                                      targets=targets)
+
+    with open(stats_csv, 'w+') as f:
+        f.write(stats_raw)
+
+    return stats_raw
+
+# The equivalent of running create_extra_graphs.py, but using the participant
+# data directly rather than the collated stats and raw data files. workers is
+# passed on to createExtraGraphs.
+def runExtraGraphs(qualtrics_csv, participants, output_dir, project, distance_cm, workers=1):
+    results = {}
+    with contextlib.redirect_stdout(io.StringIO()):
+        for exp_id in participants:
+            results[exp_id] = SHARED_RESULTS["results"].select([exp_id])
+
+    allStats = CollatedStats(qualtrics_csv, None, None, project, results=results, distance_cm=distance_cm)
+
+    # the extra graphs are written relative to the current directory, and are
+    # named after the output directory
+    cwd = os.getcwd()
+    try:
+        os.chdir(os.path.dirname(os.path.abspath(output_dir)))
+        createExtraGraphs(allStats, os.path.basename(os.path.abspath(output_dir)), workers)
+    finally:
+        os.chdir(cwd)
+
+    plt.close('all')
+
+# The stats and plots for one set of targets (all targets if target_file is
+# None). Returns the number of outputs which could not be created.
+def doStats(project, data_dir, qualtrics_csv, output_dir, workers, incremental, target_file=None):
+    targets = [TARGETS_ALL, TARGETS_ALL]
+    if target_file is not None:
+        targets = loadTargetSubset(target_file)
+
+    # without plots, the results for all targets are used (so they're shared
+    # with the previous run) and only the targets in the file are counted
+    stats_only = target_file is not None and IDEAL_STATS_ONLY
+    filter_targets = [None, None] if stats_only else targets
+
+    if not incremental:
+        shutil.rmtree(output_dir, ignore_errors=True)
+
+    qualtrics = loadQualtrics(qualtrics_csv)
+    distance_cm = DISTANCE_CM[project]
+
+    # the excluded data is dropped as it is loaded, and excluded
+    # participants' files are not read at all
+    rules = EXCLUSION_RULES + (POSITION_EXCLUSION_RULES if project == ALL_STUDIES[0] else [])
+    results_filter = ResultsFilter(exclude_where=rules, targets_top=filter_targets[0],
+                                   targets_bottom=filter_targets[1]).resolve(qualtrics)
+
+    print("Processing " + project + " project")
+    participants = {} # participant ID -> results files
+    for exp, data_csvs in resultsTree(data_dir).items():
+        exp_id = int(exp)
+        if not results_filter.includesParticipant(exp):
+            print("  excluding " + exp)
+            continue
+
+        if project == ALL_STUDIES[0]:
+            excluded = [side for side in ("top", "bottom") if not results_filter.includesLabel(exp, side)]
+            for side in excluded:
+                print("  excluding " + exp + " " + side + " data (too many validation errors)")
+
+            if len(excluded) == 2:
+                print("  all data for " + exp + " excluded")
+                continue
+
+        print("  processing experiment " + exp)
+        participants[exp_id] = data_csvs
+
+    results_filter = results_filter.forParticipants(participants)
+
+    if len(participants) == 0:
+        print("ERROR: no participant data found in " + data_dir, file=sys.stderr)
+        sys.exit(1)
+
+    plots_dir = os.path.join(output_dir, "plots")
+    all_plots_dir = os.path.join(output_dir, "all", "plots")
+    os.makedirs(plots_dir, exist_ok=True)
+    os.makedirs(all_plots_dir, exist_ok=True)
+
+    # Work out what needs to be built: (output, participants, function,
+    # arguments). The output depends on the participants' results files and
+    # the filter applied to them, as well as the arguments.
+    def analysisStage(ids, label_prefix, plot, graph_output_png, participant):
+        if stats_only:
+            return (graph_output_png + ".stats.csv", ids, runStats,
+                    (ids, label_prefix, distance_cm, graph_output_png + ".stats.csv", participant, targets))
+
+        return (graph_output_png + ".stats.csv", ids, runAnalysis,
+                (ids, label_prefix, plot, distance_cm, graph_output_png, participant))
+
+    stages = []
+    participant_stats = [] # participant stats files
+    if CREATE_INDIVIDUAL_CAT_PLOTS:
+        for exp_id in participants:
+            for plot in PLOTS:
+                graph_output_png = os.path.join(plots_dir, str(exp_id) + "_" + plot + ".png")
+                participant_stats.append(graph_output_png + ".stats.csv")
+                stages.append(analysisStage([exp_id], None, plot, graph_output_png, str(exp_id)))
+
+    print("")
+    print("  Creating composite plots...")
+
+    # split by categories
+    for catname, subcategories in CATEGORIES.items():
+        print("    " + catname)
+        cat_dir = os.path.join(output_dir, "all", catname)
+        os.makedirs(os.path.join(cat_dir, "plots"), exist_ok=True)
+
+        # the categories are views of the loaded results, with the spec type
+        # description added to the labels
+        cat_ids = qualtricsGroups(qualtrics, catname, subcategories, participants)
+        for abbrev, wildcard in subcategories.items():
+            print("      " + abbrev)
+            if len(cat_ids[abbrev]) == 0:
+                print("        - no data found (" + catname + " like " + wildcard + ")")
+                continue
+
+            for plot in PLOTS:
+                graph_output_png = os.path.join(cat_dir, "plots", project + "_" + abbrev + "_" + plot + ".png")
+                stages.append(analysisStage(cat_ids[abbrev], abbrev + " - ", plot, graph_output_png, abbrev))
+
+        # everything by category
+        print("      all together")
+        ids = []
+        label_prefixes = []
+        for abbrev in sorted(cat_ids, key=lambda a: (project + "_" + a + ".csv").lower()):
+            ids += cat_ids[abbrev]
+            label_prefixes += [abbrev + " - "] * len(cat_ids[abbrev])
+
+        if len(ids) == 0:
+            continue
+
+        for plot in PLOTS:
+            graph_output_png = os.path.join(all_plots_dir, project + "_" + catname + "_" + plot + ".png")
+            stages.append(analysisStage(ids, label_prefixes, plot, graph_output_png, catname))
+
+    # everything
+    print("    everything")
+    all_ids = sorted(participants, key=str)
+    for plot in PLOTS:
+        graph_output_png = os.path.join(all_plots_dir, project + "_" + plot + ".png")
+        stages.append(analysisStage(all_ids, None, plot, graph_output_png, None))
+
+    # additional plots
+    if CREATE_INDIVIDUAL_CAT_PLOTS and not stats_only:
+        # (the Rx plot is the first of the extra graphs)
+        extra_graphs_png = os.path.join(all_plots_dir, os.path.basename(os.path.abspath(output_dir)) + "_Rx_scatter.png")
+        stages.append((extra_graphs_png, list(participants), runExtraGraphs,
+                       (qualtrics_csv, list(participants), output_dir, project, distance_cm)))
+
+    # skip anything which was built from the same inputs last time
+    manifest = BuildManifest(os.path.join(output_dir, MANIFEST_FILE), incremental)
+    stages = [stage for stage in stages\
+              if not manifest.isCurrent(stage[0], [f for exp_id in stage[1] for f in participants[exp_id]]\
+                                        + ([qualtrics_csv] if stage[2] == runExtraGraphs else []),
+                                        (stage[3], results_filter.forParticipants(stage[1])))]
+    if incremental:
+        print("  " + str(len(stages)) + " outputs to update")
+
+    # only the participants which are needed are loaded
+    needed = set(exp_id for stage in stages for exp_id in stage[1])
+    if len(needed) > 0:
+        loadSharedResults([f for exp_id in all_ids if exp_id in needed for f in participants[exp_id]],
+                          results_filter, workers)
+
+    # the failed outputs are left out of the manifest, so they are built again
+    # next time
+    failed = runStages(stages, workers)
+    for output in failed:
+        manifest.failed(output)
+    manifest.save()
+
+    # put all of the participant data into one stats file
+    with open(os.path.join(output_dir, "all.stats.csv"), 'w') as f:
+        first = True
+        for stats_csv in sorted(participant_stats, key=lambda p: os.path.basename(p).lower()):
+            if not os.path.exists(stats_csv):
+                continue
+
+            with open(stats_csv, 'r') as stats_file:
+                lines = stats_file.readlines()
+
+            if first:
+                f.writelines(lines[:1])
+                first = False
+            f.writelines(lines[1:])
+
+    return len(failed)
+
+# Run cluster_targets.py to find the best targets. This is run separately as
+# it needs scikit-learn and kneed, which the rest of the analysis does not.
+def clusterTargets(target_stats_csv, project, best_targets_csv, cluster_png):
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "cluster_targets.py")
+    result = subprocess.run([sys.executable, script, target_stats_csv, project,
+                             best_targets_csv, cluster_png, project])
+    if result.returncode != 0:
+        print("ERROR: could not cluster targets in " + target_stats_csv, file=sys.stderr)
+        return False
+
+    return True
+
+# The best targets are worked out from the stats of a stage, which is missing
+# if the stage failed (already counted by doStats).
+def statsExist(stats_csv):
+    if not os.path.exists(stats_csv):
+        print("ERROR: cannot calculate best targets without " + stats_csv, file=sys.stderr)
+        return False
+
+    return True
+
+# keep the header and the rows for one type of vision correction
+def filterCorrectionStats(stats_csv, correction, output_csv):
+    with open(stats_csv, 'r') as f:
+        lines = f.read().splitlines()
+
+    with open(output_csv, 'w') as f:
+        for line in lines[:1] + [l for l in lines[1:] if ":: " + correction + " - " in l]:
+            print(line, file=f)
+
+if __name__ == '__main__':
+    if len(sys.argv) < 4:
+        printUsage()
+        sys.exit(1)
+
+    project = sys.argv[1]
+    data_dir = sys.argv[2]
+    qualtrics_csv = sys.argv[3]
+
+    output_dir = project
+    if len(sys.argv) > 4:
+        output_dir = sys.argv[4]
+
+    workers = os.cpu_count()
+    if len(sys.argv) > 5:
+        workers = int(sys.argv[5])
+
+    build_mode = FULL_BUILD
+    if len(sys.argv) > 6:
+        build_mode = sys.argv[6]
+
+    # error checking
+    if not project in ALL_STUDIES:
+        print("ERROR: project must be " + " or ".join(ALL_STUDIES) + ": " + project)
+        printUsage()
+        sys.exit(1)
+
+    if build_mode not in BUILD_MODES:
+        print("ERROR: invalid build mode: " + build_mode)
+        printUsage()
+        sys.exit(1)
+
+    for path in (data_dir, qualtrics_csv):
+        if not os.path.exists(path):
+            print("ERROR: input path does not exist: " + path)
+            printUsage()
+            sys.exit(1)
+
+    incremental = (build_mode == INCREMENTAL_BUILD)
+    if not incremental:
+        print("Deleting previous records, if they exist.")
+        response = None
+        while response not in ("y", "n"):
+            response = input("Are you sure you want to continue? [y/n]: ").lower()
+
+        if response == "n":
+            print("Not continuing. Goodbye.")
+            sys.exit(1)
+
+    # run stats for all
+    print(" ********** Stats for all targets **********")
+    failed = doStats(project, data_dir, qualtrics_csv, output_dir, workers, incremental)
+
+    # calculate the 'ideal' target locations
+    if project == ALL_STUDIES[0]:
+        all_plots_dir = os.path.join(output_dir, "all", "plots")
+
+        print(" ********** Calculate best targets **********")
+        vector_stats_csv = os.path.join(all_plots_dir, project + "_" + VECTOR_PLOT + ".png.stats.csv")
+        target_stats_csv = os.path.join(output_dir, "target_stats.csv")
+        best_targets_csv = os.path.join(output_dir, "best_targets.csv")
+        clustered = False
+        if statsExist(vector_stats_csv):
+            createTargetStats(vector_stats_csv, target_stats_csv, project)
+            clustered = clusterTargets(target_stats_csv, project, best_targets_csv,
+                                       os.path.join(all_plots_dir, project + "_cluster_targets.png"))
+
+        # run stats again for these ideal locations
+        if RUN_IDEAL_STATS and clustered:
+            print(" ********** Stats for ideal targets **********")
+            failed += doStats(project, data_dir, qualtrics_csv, output_dir + "_ideal", workers, incremental,
+                              best_targets_csv)
+
+        # strip out the different correction modalities and run stats for those too
+        for corr in IDEAL_CORRECTIONS:
+            print(" ********** Calculate best targets - " + corr + " **********")
+            corr_vector_stats_csv = os.path.join(all_plots_dir, project + "_Correction_" + VECTOR_PLOT + ".png.stats.csv")
+            if not statsExist(corr_vector_stats_csv):
+                continue
+
+            corr_stats_csv = os.path.join(all_plots_dir, project + "_Correction_" + VECTOR_PLOT + "_" + corr + ".png.stats.csv")
+            filterCorrectionStats(corr_vector_stats_csv, corr, corr_stats_csv)
+
+            # calculate the stats using this data subset
+            target_stats_csv = os.path.join(output_dir, "target_stats_" + corr + ".csv")
+            best_targets_csv = os.path.join(output_dir, "best_targets_" + corr + ".csv")
+            createTargetStats(corr_stats_csv, target_stats_csv, project)
+
+            # and cluster
+            clustered = clusterTargets(target_stats_csv, project, best_targets_csv,
+                                       os.path.join(all_plots_dir, project + "_cluster_targets_" + corr + ".png"))
+
+            if RUN_IDEAL_STATS and clustered:
+                print(" ********** Stats for ideal targets - " + corr + " **********")
+                failed += doStats(project, data_dir, qualtrics_csv, output_dir + "_ideal_" + corr, workers,
+                                  incremental, best_targets_csv)
+
+    if failed > 0:
+        print("ERROR: " + str(failed) + " outputs could not be created (see above)", file=sys.stderr)
+        sys.exit(1)
+
+    print("Finished. Have a nice day :)")
+
+# EOF
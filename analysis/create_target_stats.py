@@ -8,31 +8,10 @@ import sys
 
 from ExperimentResults import ALL_STUDIES
 
-if __name__ == '__main__':
-    if len(sys.argv) < 3:
-        print("Usage:", sys.argv[0], "<input_stats_csv> <output_csv>",
-              "[<study=" + ALL_STUDIES[1] + ">]")
-        sys.exit(1)
-
-    input_csv = sys.argv[1]
-    output_csv = sys.argv[2]
-
-    study = ALL_STUDIES[1]
+def createTargetStats(input_csv, output_csv, study=ALL_STUDIES[1]):
     positions = ("far_chinrest", "mid_chinrest", "mid_unrestricted", "near_chinrest")
-    if len(sys.argv) > 3:
-        study = sys.argv[3]
-
-        if study == ALL_STUDIES[0]:
-            positions = ("Top", "Bottom")
-
-    # error checking
-    if not os.path.exists(input_csv):
-        print("ERROR: input csv file does not exist:", input_csv, file=sys.stderr)
-        sys.exit(1)
-
-    if not study in ALL_STUDIES:
-        print("ERROR: invalid study:", study, file=sys.stderr)
-        sys.exit(1)
+    if study == ALL_STUDIES[0]:
+        positions = ("Top", "Bottom")
 
     # retrieve the stats
     targStats = {}
@@ -75,4 +54,28 @@ if __name__ == '__main__':
 
     print("Done. File written to", output_csv)
 
+if __name__ == '__main__':
+    if len(sys.argv) < 3:
+        print("Usage:", sys.argv[0], "<input_stats_csv> <output_csv>",
+              "[<study=" + ALL_STUDIES[1] + ">]")
+        sys.exit(1)
+
+    input_csv = sys.argv[1]
+    output_csv = sys.argv[2]
+
+    study = ALL_STUDIES[1]
+    if len(sys.argv) > 3:
+        study = sys.argv[3]
+
+    # error checking
+    if not os.path.exists(input_csv):
+        print("ERROR: input csv file does not exist:", input_csv, file=sys.stderr)
+        sys.exit(1)
+
+    if not study in ALL_STUDIES:
+        print("ERROR: invalid study:", study, file=sys.stderr)
+        sys.exit(1)
+
+    createTargetStats(input_csv, output_csv, study)
+
 # EOF
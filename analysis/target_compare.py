@@ -4,7 +4,8 @@ import os
 from scipy import stats
 import sys
 
-from create_extra_graphs import kruskalTest
+from create_extra_graphs import SPEARMAN, kruskalTest
+from TestCache import cachedTest, trimTestCache
 
 def printUsage():
     print("Usage:", sys.argv[0], "<target_csv>")
@@ -78,7 +79,9 @@ if __name__ == '__main__':
                     invalid_scatter[1].append(sum(vals))
 
                 print("Invalid per row")
-                print(stats.spearmanr(*invalid_scatter))
+                print(cachedTest(SPEARMAN, stats.spearmanr, *invalid_scatter))
                 print("")
 
+    trimTestCache()
+
 # EOF